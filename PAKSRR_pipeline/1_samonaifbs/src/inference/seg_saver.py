@@ -25,17 +25,107 @@ else:
 
 # from predictor import SamPredictor
 import os
+from collections import OrderedDict
 
 from segment_anything import build_sam, build_sam_vit_b,SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
 import cv2
 import SimpleITK as sitk
 import numpy as np
 import matplotlib.pyplot as plt
 import torch
-import imageio
 from numpy import *
 import warnings
 from scipy.ndimage import zoom
+
+SAM_CHECKPOINT = "../../models/sam_vit_b_01ec64.pth"
+# SAM predictors shared by the whole process, keyed on (checkpoint, device)
+_sam_predictors = {}
+def get_sam_predictor(checkpoint=SAM_CHECKPOINT, device=None):
+    """
+    Return the SAM ViT-B predictor for ``checkpoint`` on ``device``, building it on first use.
+    ``device`` defaults to CUDA if available, CPU otherwise.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    key = (os.path.abspath(checkpoint), str(device))
+    if key not in _sam_predictors:
+        _sam_predictors[key] = SamPredictor(build_sam_vit_b(checkpoint=checkpoint).to(device=device))
+        _sam_predictors[key].sam_key = key
+    return _sam_predictors[key]
+# SAM image embeddings on CPU, keyed on (predictor key, filename, slice index), least recently used first
+SAM_EMBEDDING_CACHE_SIZE = 64
+_sam_embeddings = OrderedDict()
+def clear_sam_embeddings(filename=None):
+    """
+    Drop the cached SAM embeddings of every file but ``filename``, or all of them if ``filename`` is None.
+    """
+    for key in list(_sam_embeddings):
+        if filename is None or key[1] != filename:
+            del _sam_embeddings[key]
+@torch.no_grad()
+def get_sam_embeddings(predictor, images, keys=None, batch_size=4):
+    """
+    Compute the SAM image embeddings of a list of HxWx3 uint8 slices in batched encoder passes.
+    If ``keys`` is given, embeddings are looked up in and stored to the (file, slice) cache of this predictor.
+    The cache keeps at most SAM_EMBEDDING_CACHE_SIZE embeddings on CPU and evicts the least recently used.
+    """
+    if keys is not None:
+        # embeddings of different checkpoints or devices must not be mixed
+        predictor_key = getattr(predictor, "sam_key", id(predictor))
+        keys = [(predictor_key,) + tuple(key) for key in keys]
+    features = [None] * len(images)
+    todo = []
+    for n in range(len(images)):
+        if keys is not None and keys[n] in _sam_embeddings:
+            _sam_embeddings.move_to_end(keys[n])
+            features[n] = _sam_embeddings[keys[n]].to(predictor.device)
+        else:
+            todo.append(n)
+    for start in range(0, len(todo), batch_size):
+        chunk = todo[start:start + batch_size]
+        batch = []
+        for n in chunk:
+            input_image = predictor.transform.apply_image(images[n])
+            input_image = torch.as_tensor(input_image, device=predictor.device)
+            input_image = input_image.permute(2, 0, 1).contiguous()[None, :, :, :]
+            batch.append(predictor.model.preprocess(input_image))
+        batch_features = predictor.model.image_encoder(torch.cat(batch))
+        for n, feature in zip(chunk, batch_features):
+            features[n] = feature[None]
+            if keys is not None:
+                _sam_embeddings[keys[n]] = features[n].cpu()
+                if len(_sam_embeddings) > SAM_EMBEDDING_CACHE_SIZE:
+                    _sam_embeddings.popitem(last=False)
+    return features
+def set_sam_embedding(predictor, features, original_size):
+    """
+    Load a precomputed image embedding into ``predictor`` so that ``predict`` can decode prompts against it.
+    """
+    predictor.reset_image()
+    predictor.original_size = tuple(original_size)
+    predictor.input_size = ResizeLongestSide.get_preprocess_shape(
+        original_size[0], original_size[1], predictor.transform.target_length)
+    predictor.features = features
+    predictor.is_image_set = True
+def to_uint8(image):
+    """
+    Window a 2D slice to uint8 in memory. Images already in [0, 1] are scaled by 255,
+    any other range is stretched from [min, max] to [0, 255].
+    """
+    image = np.asarray(image, dtype=np.float64)
+    image_min, image_max = image.min(), image.max()
+    if image_min < 0 or image_max > 1:
+        if image_max > image_min:
+            image = (image - image_min) / (image_max - image_min)
+        else:
+            image = np.zeros_like(image)
+    return (image * 255 + 0.5).astype(np.uint8)
+def to_uint8_rgb(image):
+    """
+    Window a 2D slice to uint8 and replicate it to the HxWx3 layout expected by SAM.
+    """
+    return np.repeat(to_uint8(image)[:, :, None], 3, axis=2)
 def bounding_box(mask):
     mask=mask.detach().cpu().numpy()
     coords = np.column_stack(np.where(mask>0.5))
@@ -43,40 +133,31 @@ def bounding_box(mask):
     x_max, y_max = coords.max(axis=0)
     return np.array([y_min, x_min,y_max, x_max])
 def find_hole(mask):
-    mask = mask.detach().cpu().numpy()
-    imageio.imwrite("slice.png", mask)
-    mask = cv2.imread("slice.png")
+    mask = to_uint8(mask.detach().cpu().numpy())
     # blurred = cv2.GaussianBlur(mask, (5, 5), 0)
     edged = cv2.Canny(mask, 30, 150)
     contours, hierarchy = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     return len(contours)
 def detect_slice(engine_output):
-    index_list=[]
-    for s in range(1,engine_output.shape[-1]-1):
-        # if engine_output[:,:,s].sum()<1 and engine_output[:,:,s-1].sum()>1 and engine_output[:,:,s+1].sum()>1:
-        #     index_list.append(s)
-        # elif engine_output[:,:,s].sum()<(0.25*(engine_output[:,:,s-1]+engine_output[:,:,s+1])).sum():
-        #     index_list.append(s)
-        # elif find_hole(engine_output[:,:,s])>1:
-        #     index_list.append(s)
-        if engine_output[:,:,s].sum()<0.95*engine_output[:,:,s-1].sum() and engine_output[:,:,s].sum()<0.95*engine_output[:,:,s+1].sum():
-            index_list.append(s)
-            # print(s)
-    return index_list
-def sam_process(engine_output, meta_data):
+    # flag slices whose mask area drops by more than 5% w.r.t. both neighbours
+    areas = engine_output.sum(dim=(0, 1))
+    flagged = (areas[1:-1] < 0.95 * areas[:-2]) & (areas[1:-1] < 0.95 * areas[2:])
+    # single host sync for the whole volume
+    return (torch.nonzero(flagged).flatten() + 1).tolist()
+def sam_process(engine_output, meta_data, predictor=None, batched=False, batch_size=4, cache_embeddings=False):
+    if predictor is None:
+        predictor = get_sam_predictor()
     index=detect_slice(engine_output[0,0])
     sitk_image=sitk.ReadImage(meta_data["filename_or_obj"])
     np_image=sitk.GetArrayFromImage(sitk_image)[0].transpose(2,1,0)
     T=(engine_output.shape[2]/np_image.shape[0],engine_output.shape[3]/np_image.shape[1],1)
     np_image=zoom(np_image,T)
+    if batched:
+        return sam_process_batched(engine_output, meta_data, predictor, np_image, index, batch_size, cache_embeddings)
     for i in index:
-        image = np_image[:,:,i]
+        image = to_uint8_rgb(np_image[:,:,i])
         label=engine_output[0,0,:,:,i-1]+engine_output[0,0,:,:,i+1]
-        imageio.imwrite("slice.png", image)
-        image = cv2.imread("slice.png")
         input_box = bounding_box(label)
-        predictor = SamPredictor(
-            build_sam_vit_b(checkpoint="../../models/sam_vit_b_01ec64.pth").to(device="cuda"))
         predictor.set_image(image)
         masks, scores, logits = predictor.predict(
             point_coords=None,
@@ -87,14 +168,42 @@ def sam_process(engine_output, meta_data):
         masks = masks * 1
         engine_output[0,0,:,:,i] = torch.tensor(masks[0])
     return engine_output
+def sam_process_batched(engine_output, meta_data, predictor, np_image, index, batch_size=4, cache_embeddings=False):
+    if len(index) == 0:
+        return engine_output
+    images = [to_uint8_rgb(np_image[:,:,i]) for i in index]
+    keys = None
+    if cache_embeddings:
+        filename = meta_data["filename_or_obj"]
+        if isinstance(filename, (list, tuple)):
+            filename = filename[0]
+        # only the slices of the current volume can be reused
+        clear_sam_embeddings(filename)
+        keys = [(filename, i) for i in index]
+    features = get_sam_embeddings(predictor, images, keys, batch_size)
+    # decode every box prompt against its slice embedding
+    for i, image, feature in zip(index, images, features):
+        label=engine_output[0,0,:,:,i-1]+engine_output[0,0,:,:,i+1]
+        input_box = bounding_box(label)
+        set_sam_embedding(predictor, feature, image.shape[:2])
+        masks, scores, logits = predictor.predict(
+            point_coords=None,
+            point_labels=None,
+            box=input_box[None, :],
+            multimask_output=False,
+        )
+        engine_output[0,0,:,:,i] = torch.tensor(masks[0] * 1)
+    return engine_output
 
+def neighbour_overlap(engine_output):
+    # overlap of each inner slice with both of its neighbours, shape [S-2]
+    triple = engine_output[..., 1:-1] * engine_output[..., :-2] * engine_output[..., 2:]
+    return triple.sum(dim=tuple(range(triple.dim() - 1)))
 def merge_samonai(engine_output_monai, engine_output_sam):
+    # keep the SAM slice wherever it agrees better with its neighbours than the MONAI one
+    use_sam = neighbour_overlap(engine_output_monai) < neighbour_overlap(engine_output_sam)
     output=engine_output_monai.clone()
-    for i in range(1,engine_output_monai.shape[-1]-1):
-        if (engine_output_monai[:,:,:,:,i]*engine_output_monai[:,:,:,:,i-1]*engine_output_monai[:,:,:,:,i+1]).sum()<(engine_output_sam[:,:,:,:,i]*engine_output_sam[:,:,:,:,i-1]*engine_output_sam[:,:,:,:,i+1]).sum():
-            output[:,:,:,:,i]=engine_output_sam[:,:,:,:,i]
-        else:
-            output[:,:,:,:,i]=engine_output_monai[:,:,:,:,i]
+    output[..., 1:-1] = torch.where(use_sam, engine_output_sam[..., 1:-1], engine_output_monai[..., 1:-1])
     return output
 class SegmentationSaver:
     """
@@ -114,6 +223,11 @@ class SegmentationSaver:
         batch_transform: Callable = lambda x: x,
         output_transform: Callable = lambda x: x,
         name: Optional[str] = None,
+        sam_checkpoint: str = SAM_CHECKPOINT,
+        sam_device: Optional[Union[str, torch.device]] = None,
+        sam_batched: bool = False,
+        sam_batch_size: int = 4,
+        sam_cache_embeddings: bool = False,
     ) -> None:
         """
         Args:
@@ -150,6 +264,15 @@ class SegmentationSaver:
                 The first dimension of this transform's output will be treated as the
                 batch dimension. Each item in the batch will be saved individually.
             name: identifier of logging.logger to use, defaulting to `engine.logger`.
+            sam_checkpoint: path to the SAM ViT-B checkpoint used to refine suspicious slices.
+            sam_device: device to run SAM on. Defaults to CUDA if available, CPU otherwise.
+                The predictor is loaded once per process and shared by all savers.
+            sam_batched: whether to compute the SAM embeddings of all flagged slices of a volume
+                in batched encoder passes before decoding the box prompts. Defaults to False.
+            sam_batch_size: number of slices per batched encoder pass.
+            sam_cache_embeddings: whether to cache the SAM embeddings per (file, slice) so that
+                reruns with different prompts skip the encoder. Only used if ``sam_batched``.
+                The cache is kept on CPU for the current volume only, up to SAM_EMBEDDING_CACHE_SIZE slices.
 
         """
         self.saver: Union[NiftiSaver, PNGSaver]
@@ -174,6 +297,11 @@ class SegmentationSaver:
             )
         self.batch_transform = batch_transform
         self.output_transform = output_transform
+        self.sam_checkpoint = sam_checkpoint
+        self.sam_device = sam_device
+        self.sam_batched = sam_batched
+        self.sam_batch_size = sam_batch_size
+        self.sam_cache_embeddings = sam_cache_embeddings
 
         self.logger = logging.getLogger(name)
         self._name = name
@@ -199,7 +327,9 @@ class SegmentationSaver:
         meta_data = self.batch_transform(engine.state.batch)
         engine_output_monai = self.output_transform(engine.state.output)
         # try:
-        engine_output_sam=sam_process(engine_output_monai, meta_data)
+        predictor = get_sam_predictor(self.sam_checkpoint, self.sam_device)
+        engine_output_sam=sam_process(engine_output_monai, meta_data, predictor, self.sam_batched,
+                                      self.sam_batch_size, self.sam_cache_embeddings)
         engine_output = merge_samonai(engine_output_monai, engine_output_sam)
         # except:pass
         self.saver.save_batch(engine_output, meta_data)
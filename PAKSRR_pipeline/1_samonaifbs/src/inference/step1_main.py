@@ -52,8 +52,9 @@ from monai.transforms import (
 )
 
 import monaifbs
-from monaifbs.src.utils.custom_inferer import SlidingWindowInferer2D
+from monaifbs.src.utils.custom_inferer import SlidingWindowInferer2D, SliceBatchInferer2D, FlipInferer
 from monaifbs.src.utils.custom_transform import InPlaneSpacingd
+from monaifbs.src.utils.custom_network import CPUOptimizedNetwork
 
 
 def create_data_list_of_dictionaries(input_files):
@@ -119,8 +120,19 @@ def run_inference(input_data, config_info):
     if not os.path.exists(model_to_load):
         raise FileNotFoundError('Trained model not found')
     patch_size = config_info["inference"]["inplane_size"] + [1]
+    # test-time flip augmentation params
+    tta_flips = config_info['inference'].get('tta_flips', ["none", "x", "y", "xy"])
+    tta_batched = config_info['inference'].get('tta_batched', False)
+    # slice-batched inference params
+    slice_batched = config_info['inference'].get('slice_batched', False)
+    memory_budget = config_info['inference'].get('memory_budget', 2048)
+    # SAM refinement params (optional section of the config file)
+    sam_config = config_info.get('sam') or {}
     print("Considering patch size = {}".format(patch_size))
 
+    # CPU performance mode params (optional section of the config file)
+    cpu_config = config_info.get('cpu') or {}
+
     # set up either GPU or CPU usage
     if torch.cuda.is_available():
         print("\n#### GPU INFORMATION ###")
@@ -129,6 +141,9 @@ def run_inference(input_data, config_info):
     else:
         current_device = torch.device("cpu")
         print("Using device: {}".format(current_device))
+        if cpu_config.get('num_threads') is not None:
+            torch.set_num_threads(cpu_config['num_threads'])
+        print("Using {} threads".format(torch.get_num_threads()))
 
     """
     Data Preparation
@@ -200,10 +215,24 @@ def run_inference(input_data, config_info):
         res_block=False
     ).to(current_device)
 
+    # the checkpoint is loaded into net, the evaluator runs the optimized wrapper around it
+    eval_net = net
+    if current_device.type == "cpu" and cpu_config.get('performance_mode', False):
+        eval_net = CPUOptimizedNetwork(net,
+                                       channels_last=cpu_config.get('channels_last', True),
+                                       bfloat16=cpu_config.get('bfloat16', False),
+                                       torchscript=cpu_config.get('torchscript', True),
+                                       compare_fp32=cpu_config.get('report_accuracy', False))
+
     """
     Set ignite evaluator to perform inference
     """
     print("***  Preparing evaluator ... ")
+    if slice_batched:
+        slice_inferer = SliceBatchInferer2D(roi_size=patch_size, memory_budget=memory_budget,
+                                            sw_batch_size=4, overlap=0.0)
+    else:
+        slice_inferer = SlidingWindowInferer2D(roi_size=patch_size, sw_batch_size=4, overlap=0.0)
     if nr_out_channels == 1:
         do_sigmoid = True
         do_softmax = False
@@ -229,6 +258,9 @@ def run_inference(input_data, config_info):
             output_postfix=config_info['output']['out_postfix'],
             batch_transform=lambda batch: batch["image_meta_dict"],
             output_transform=lambda output: output["pred"],
+            sam_batched=sam_config.get('batched', False),
+            sam_batch_size=sam_config.get('batch_size', 4),
+            sam_cache_embeddings=sam_config.get('cache_embeddings', False),
         ),
     ]
 
@@ -241,17 +273,10 @@ def run_inference(input_data, config_info):
             inputs = inputs.to(engine.state.device)
             if targets is not None:
                 targets = targets.to(engine.state.device)
-            flip_inputs_1 = torch.flip(inputs, dims=(2,))
-            flip_inputs_2 = torch.flip(inputs, dims=(3,))
-            flip_inputs_3 = torch.flip(inputs, dims=(2, 3))
 
             def _compute_pred():
-                pred = self.inferer(inputs, self.network)
-                # use random flipping as data augmentation at inference
-                flip_pred_1 = torch.flip(self.inferer(flip_inputs_1, self.network), dims=(2,))
-                flip_pred_2 = torch.flip(self.inferer(flip_inputs_2, self.network), dims=(3,))
-                flip_pred_3 = torch.flip(self.inferer(flip_inputs_3, self.network), dims=(2, 3))
-                return (pred + flip_pred_1 + flip_pred_2 + flip_pred_3) / 4
+                # flipping is used as data augmentation at inference (see FlipInferer)
+                return self.inferer(inputs, self.network)
 
             # execute forward computation
             self.network.eval()
@@ -269,9 +294,9 @@ def run_inference(input_data, config_info):
     evaluator = DynUNetEvaluator(
         device=current_device,
         val_data_loader=val_loader,
-        network=net,
+        network=eval_net,
         prepare_batch=prepare_batch,
-        inferer=SlidingWindowInferer2D(roi_size=patch_size, sw_batch_size=4, overlap=0.0),
+        inferer=FlipInferer(slice_inferer, flips=tta_flips, batched=tta_batched),
         post_transform=val_post_transforms,
         val_handlers=val_handlers,
         amp=False,
@@ -282,6 +307,10 @@ def run_inference(input_data, config_info):
     """
     print("***  Running evaluator ... ")
     evaluator.run()
+    if isinstance(eval_net, CPUOptimizedNetwork) and eval_net.compare_fp32:
+        accuracy = eval_net.report_accuracy()
+        print("CPU performance mode vs fp32: max abs output difference = {:.3e}, label mismatch = {:.4%}".format(
+            accuracy["max_abs_diff"], accuracy["label_mismatch"]))
     print("Done!")
 
     return
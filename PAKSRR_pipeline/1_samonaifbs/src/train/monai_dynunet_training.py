@@ -73,7 +73,7 @@ from monai.inferers import SimpleInferer
 
 from monaifbs.src.utils.custom_transform import InPlaneSpacingd
 from monaifbs.src.utils.custom_losses import DiceCELoss, DiceLossExtended
-from monaifbs.src.utils.custom_inferer import SlidingWindowInferer2D
+from monaifbs.src.utils.custom_inferer import SlidingWindowInferer2D, FlipInferer
 
 import monaifbs
 
@@ -224,6 +224,9 @@ def run_training(train_file_list, valid_file_list, config_info):
     nr_out_channels = len(seg_labels)
     print("Considering the following {} labels in the segmentation: {}".format(nr_out_channels, seg_labels))
     patch_size = config_info["training"]["inplane_size"] + [1]
+    # test-time flip augmentation params
+    tta_flips = config_info['training'].get('tta_flips', ["none", "x", "y", "xy"])
+    tta_batched = config_info['training'].get('tta_batched', False)
     print("Considering patch size = {}".format(patch_size))
 
     spacing = config_info["training"]["spacing"]
@@ -458,17 +461,10 @@ def run_training(train_file_list, valid_file_list, config_info):
         def _iteration(self, engine, batchdata):
             inputs, targets = self.prepare_batch(batchdata)
             inputs, targets = inputs.to(engine.state.device), targets.to(engine.state.device)
-            flip_inputs_1 = torch.flip(inputs, dims=(2,))
-            flip_inputs_2 = torch.flip(inputs, dims=(3,))
-            flip_inputs_3 = torch.flip(inputs, dims=(2, 3))
 
             def _compute_pred():
-                pred = self.inferer(inputs, self.network)
-                # use random flipping as data augmentation at inference
-                flip_pred_1 = torch.flip(self.inferer(flip_inputs_1, self.network), dims=(2,))
-                flip_pred_2 = torch.flip(self.inferer(flip_inputs_2, self.network), dims=(3,))
-                flip_pred_3 = torch.flip(self.inferer(flip_inputs_3, self.network), dims=(2, 3))
-                return (pred + flip_pred_1 + flip_pred_2 + flip_pred_3) / 4
+                # flipping is used as data augmentation at inference (see FlipInferer)
+                return self.inferer(inputs, self.network)
 
             # execute forward computation
             self.network.eval()
@@ -484,7 +480,8 @@ def run_training(train_file_list, valid_file_list, config_info):
         device=current_device,
         val_data_loader=val_loader,
         network=net,
-        inferer=SlidingWindowInferer2D(roi_size=patch_size, sw_batch_size=4, overlap=0.0),
+        inferer=FlipInferer(SlidingWindowInferer2D(roi_size=patch_size, sw_batch_size=4, overlap=0.0),
+                            flips=tta_flips, batched=tta_batched),
         post_transform=None,
         key_val_metric={
             "Mean_dice": MeanDice(
@@ -21,7 +21,7 @@
 
 import copy
 import torch
-from typing import Union
+from typing import Optional, Union
 
 from monai.inferers.utils import sliding_window_inference
 from monai.inferers import Inferer
@@ -59,6 +59,35 @@ class Predict2DFrom3D:
         return predictions
 
 
+class StackedPredictor:
+    """
+    Run a predictor once on several copies of the input stacked along the channel dimension.
+    The copies are moved to the batch dimension for the forward pass and the predictions are stacked back
+    along the channel dimension, i.e. [N, K*C, ...] -> [N*K, C, ...] -> [N*K, M, ...] -> [N, K*M, ...].
+    Args:
+        predictor (Network): trained network to perform the prediction
+        nr_copies: int, number of copies K stacked along the channel dimension
+    """
+    def __init__(self,
+                 predictor,
+                 nr_copies):
+        self.predictor = predictor
+        self.nr_copies = nr_copies
+
+    def __call__(self, data):
+        """
+        Callable function to perform the prediction on the stacked input data.
+        Args:
+            data: torch.tensor, model input data for inference, with the copies stacked along dimension 1.
+        :return:
+        """
+        size = list(data.shape)
+        data = torch.reshape(data, [size[0] * self.nr_copies, size[1] // self.nr_copies] + size[2:])
+        predictions = self.predictor(data)  # one forward pass for all the copies
+        new_size = [size[0], self.nr_copies * predictions.shape[1]] + list(predictions.shape[2:])
+        return torch.reshape(predictions, new_size)
+
+
 class SlidingWindowInferer2D(Inferer):
     """
     Sliding window method for model inference,
@@ -111,6 +140,95 @@ class SlidingWindowInferer2D(Inferer):
                                         predictor_2d, self.overlap, self.mode)
 
 
+class SliceBatchInferer2D(Inferer):
+    """
+    Slice-batched method for model inference on 3D volumes with a 2D network.
+    When the in-plane size of the input fits the patch size, the slices are padded to the patch size (as done by
+    sliding_window_inference), moved to the batch dimension as [B*D, C, H, W] and fed through the network in
+    batches sized to fit `memory_budget`. The 3D output is reassembled directly, without the generic
+    sliding-window bookkeeping. Otherwise, it falls back to SlidingWindowInferer2D.
+
+    Args:
+        roi_size (list, tuple): the 2D patch size (followed by 1 for the slice dimension).
+            If it has non-positive components, the corresponding `inputs` size will be used.
+        memory_budget: approximate memory in MB available to a forward pass, used to choose the number of slices
+            per forward call.
+        activations_per_voxel: approximate number of activations the network keeps in memory per input voxel
+            during a forward pass, used to convert `memory_budget` into a number of slices.
+        max_batch_size: optional upper bound on the number of slices per forward call.
+        sw_batch_size: the batch size to run window slices in the sliding window fallback.
+        overlap: Amount of overlap between scans in the sliding window fallback.
+        mode: {``"constant"``, ``"gaussian"``}
+            How to blend output of overlapping windows in the sliding window fallback. Defaults to ``"constant"``.
+
+    """
+
+    def __init__(
+        self, roi_size, memory_budget: float = 2048, activations_per_voxel: int = 256,
+            max_batch_size: Optional[int] = None, sw_batch_size: int = 4, overlap: float = 0.0,
+            mode: Union[BlendMode, str] = BlendMode.CONSTANT
+    ):
+        Inferer.__init__(self)
+        self.roi_size = roi_size
+        self.memory_budget = memory_budget
+        self.activations_per_voxel = activations_per_voxel
+        self.max_batch_size = max_batch_size
+        self.sliding_window_inferer = SlidingWindowInferer2D(roi_size, sw_batch_size, overlap, mode)
+
+    def get_batch_size(self, inputs: torch.Tensor, slice_size):
+        """
+        Number of slices per forward call that fit into the memory budget.
+        Args:
+            inputs: torch.tensor, model input data for inference.
+            slice_size: list, padded in-plane size of the slices.
+        :return:
+        """
+        # stacked copies along the channel dimension (e.g. batched flips) each go through the network
+        bytes_per_slice = inputs.shape[1] * slice_size[0] * slice_size[1] * \
+            self.activations_per_voxel * inputs.element_size()
+        batch_size = max(1, int(self.memory_budget * 1024 ** 2 // bytes_per_slice))
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
+        return batch_size
+
+    def __call__(self, inputs: torch.Tensor, network):
+        """
+        Unified callable function API of Inferers.
+
+        Args:
+            inputs (torch.tensor): model input data for inference.
+            network (Network): target model to execute inference.
+
+        """
+        image_size = list(inputs.shape[2:4])
+        roi_size = [r if r is not None and r > 0 else i for r, i in zip(self.roi_size[:2], image_size)]
+        if any(i > r for i, r in zip(image_size, roi_size)):
+            return self.sliding_window_inferer(inputs, network)
+
+        # pad the slices to the patch size, as in sliding_window_inference
+        pad_size = [0, 0]
+        for k in (1, 0):
+            diff = roi_size[k] - image_size[k]
+            pad_size.extend([diff // 2, diff - diff // 2])
+        inputs = torch.nn.functional.pad(inputs, pad=pad_size, mode="constant", value=0.0)
+
+        # [B, C, H, W, D] -> [B*D, C, H, W]
+        nr_batch, nr_channels, _, _, nr_slices = inputs.shape
+        slices = inputs.permute(0, 4, 1, 2, 3).reshape([nr_batch * nr_slices, nr_channels] + roi_size)
+        batch_size = self.get_batch_size(inputs, roi_size)
+        outputs = None
+        for start in range(0, slices.shape[0], batch_size):
+            predictions = network(slices[start:start + batch_size])  # batched slice segmentation
+            if outputs is None:
+                outputs = torch.zeros([slices.shape[0], predictions.shape[1]] + roi_size,
+                                      dtype=torch.float32, device=inputs.device)
+            outputs[start:start + batch_size] = predictions
+
+        # [B*D, M, H, W] -> [B, M, H, W, D], cropped back to the input size
+        outputs = outputs.reshape([nr_batch, nr_slices, outputs.shape[1]] + roi_size).permute(0, 2, 3, 4, 1)
+        return outputs[:, :, pad_size[4]:pad_size[4] + image_size[0], pad_size[2]:pad_size[2] + image_size[1]]
+
+
 class SlidingWindowInferer2DWithResize(Inferer):
     """
     Sliding window method for model inference,
@@ -170,4 +288,59 @@ class SlidingWindowInferer2DWithResize(Inferer):
 
         # resize back to original size
         outputs = torch.nn.functional.interpolate(outputs, size=orig_size[2:], mode='nearest')
-        return outputs
\ No newline at end of file
+        return outputs
+
+
+# flips applied to the in-plane dimensions of [B, C, H, W, D] inputs at test time
+FLIP_DIMS = {"none": (), "x": (2,), "y": (3,), "xy": (2, 3)}
+
+
+def _flip(data, dims):
+    return torch.flip(data, dims=dims) if len(dims) > 0 else data
+
+
+class FlipInferer(Inferer):
+    """
+    Test-time flip augmentation around another inferer. The prediction is computed on the original and/or flipped
+    inputs, flipped back and averaged.
+    If `batched` is True, the flipped copies are stacked along the channel dimension and go through a single pass of
+    the wrapped inferer, where each forward call processes all copies of a window at once (see StackedPredictor).
+    Otherwise, the wrapped inferer runs once per flip.
+
+    Args:
+        inferer (Inferer): inferer used for every flip, e.g. SlidingWindowInferer2D.
+        flips (list, tuple): flips to average over, from {``"none"``, ``"x"``, ``"y"``, ``"xy"``}.
+            Defaults to all four. Use ``["none"]`` to disable test-time augmentation.
+        batched: whether to run all flips in one pass of the wrapped inferer. Defaults to False.
+
+    """
+
+    def __init__(self, inferer, flips=("none", "x", "y", "xy"), batched: bool = False):
+        Inferer.__init__(self)
+        for flip in flips:
+            if flip not in FLIP_DIMS:
+                raise ValueError("flips must be in " + str(list(FLIP_DIMS.keys())))
+        if len(flips) == 0:
+            raise ValueError("flips must contain at least one of " + str(list(FLIP_DIMS.keys())))
+        self.inferer = inferer
+        self.flips = list(flips)
+        self.batched = batched
+
+    def __call__(self, inputs: torch.Tensor, network):
+        """
+        Unified callable function API of Inferers.
+
+        Args:
+            inputs (torch.tensor): model input data for inference.
+            network (Network): target model to execute inference.
+
+        """
+        flip_dims = [FLIP_DIMS[flip] for flip in self.flips]
+        if self.batched and len(flip_dims) > 1:
+            stacked_inputs = torch.cat([_flip(inputs, dims) for dims in flip_dims], dim=1)
+            stacked_pred = self.inferer(stacked_inputs, StackedPredictor(network, len(flip_dims)))
+            preds = [_flip(pred, dims) for pred, dims in
+                     zip(torch.chunk(stacked_pred, len(flip_dims), dim=1), flip_dims)]
+        else:
+            preds = [_flip(self.inferer(_flip(inputs, dims), network), dims) for dims in flip_dims]
+        return sum(preds) / len(preds)
@@ -0,0 +1,84 @@
+##
+# \file       custom_network.py
+# \brief      contains a wrapper to run a trained 2D network efficiently on CPU at inference: TorchScript tracing,
+#               channels-last memory format and optional bfloat16 autocast. The wrapper can also compare its
+#               predictions against the eager fp32 network on the same inputs.
+#
+# \date       2026-10-17
+
+import torch
+
+
+class CPUOptimizedNetwork(torch.nn.Module):
+    """
+    Wrap a trained 2D network for fast inference on CPU.
+    The network is traced with TorchScript on the first forward pass, so that the trained weights loaded at the start
+    of the evaluation (e.g. by CheckpointLoader) are the ones being traced.
+    Args:
+        network (Network): trained network taking [N, C, H, W] inputs.
+        channels_last: bool, whether to run the network with the channels-last memory format.
+        bfloat16: bool, whether to run the network under bfloat16 autocast.
+        torchscript: bool, whether to trace and freeze the network with TorchScript.
+        compare_fp32: bool, whether to also run the eager fp32 network on the same inputs and keep track of the
+            difference between the two predictions (see report_accuracy).
+    """
+    def __init__(self,
+                 network,
+                 channels_last=True,
+                 bfloat16=False,
+                 torchscript=True,
+                 compare_fp32=False):
+        super().__init__()
+        self.network = network
+        self.channels_last = channels_last
+        self.bfloat16 = bfloat16
+        self.torchscript = torchscript
+        self.compare_fp32 = compare_fp32
+        if self.channels_last:
+            self.network.to(memory_format=torch.channels_last)
+        self._traced = None
+        self._max_abs_diff = 0.
+        self._nr_voxels = 0
+        self._nr_voxels_changed = 0
+
+    def _get_network(self, data):
+        if not self.torchscript or self.training:
+            return self.network
+        if self._traced is None:
+            with torch.no_grad():
+                self._traced = torch.jit.freeze(torch.jit.trace(self.network.eval(), data, check_trace=False))
+        return self._traced
+
+    def forward(self, data):
+        """
+        Args:
+            data: torch.tensor, model input data for inference.
+        :return: fp32 predictions of the network
+        """
+        if self.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+        network = self._get_network(data)
+        with torch.cpu.amp.autocast(enabled=self.bfloat16, dtype=torch.bfloat16):
+            predictions = network(data)
+        predictions = predictions.float()
+        if self.compare_fp32:
+            self._update_accuracy(predictions, self.network(data.float()).float())
+        return predictions
+
+    def _update_accuracy(self, predictions, predictions_fp32):
+        self._max_abs_diff = max(self._max_abs_diff, (predictions - predictions_fp32).abs().max().item())
+        labels = torch.argmax(predictions, dim=1)
+        labels_fp32 = torch.argmax(predictions_fp32, dim=1)
+        self._nr_voxels += labels.numel()
+        self._nr_voxels_changed += (labels != labels_fp32).sum().item()
+
+    def report_accuracy(self):
+        """
+        Difference between the optimized and the eager fp32 predictions over all the forward passes so far.
+        :return: dict with the maximum absolute difference of the network outputs and the fraction of voxels
+            whose predicted label differs
+        """
+        return {
+            "max_abs_diff": self._max_abs_diff,
+            "label_mismatch": self._nr_voxels_changed / max(self._nr_voxels, 1),
+        }
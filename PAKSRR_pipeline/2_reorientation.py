@@ -1,74 +1,148 @@
 import os
 import sys
+import json
+import hashlib
+import argparse
 import SimpleITK as sitk
 import numpy as np
-os.chdir(sys.path[0])
-
-root_path= './data/image/'
-data_path_list = os.listdir(root_path)
-s_list=[2,1,0]
-for path in data_path_list:
-    direction_index = np.array([[0, 1, 2],
-                                [3, 4, 5],
-                                [6, 7, 8]])
-    print(path)
-    img=sitk.ReadImage(root_path+path)
-    np_img=sitk.GetArrayFromImage(img).astype("float32")
-    label = sitk.ReadImage(root_path.replace("image","mask")+path)
-    np_label = sitk.GetArrayFromImage(label).astype("float32")
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def get_permutation(shape):
+    # numpy axis permutation bringing the smallest dimension (through-plane) to axis 0, by swapping it with axis 0
+    s1 = list(shape).index(min(shape))
+    T = [0, 1, 2]
+    T[0], T[s1] = T[s1], T[0]
+    return tuple(T)
+
+
+def get_sitk_order(T):
+    # sitk axis order equivalent to permuting the numpy axes by T: numpy axis k is the sitk axis 2-k
+    return [2 - T[2 - i] for i in range(3)]
+
+
+def get_output_paths(root_path, path):
+    return (root_path.replace("image", "reo_image") + path,
+            root_path.replace("image", "reo_mask") + path)
+
+
+def get_input_paths(root_path, path):
+    return root_path + path, root_path.replace("image", "mask") + path
+
+
+def get_hash(paths):
+    sha1 = hashlib.sha1()
+    for p in paths:
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+    return sha1.hexdigest()
 
 
-    np_img[np_label==0]=np_img.min()
-    np_img=np_img-np_img.min()
+def is_up_to_date(in_paths, out_paths, hashes=None, path_hash=None):
+    # outputs exist and are newer than the inputs, or match the stored hash of the inputs if hashes are used
+    if not all(os.path.exists(p) for p in out_paths):
+        return False
+    if hashes is not None:
+        return hashes.get(os.path.basename(in_paths[0])) == path_hash
+    return min(os.path.getmtime(p) for p in out_paths) >= max(os.path.getmtime(p) for p in in_paths)
+
+
+def write_image(image, path, compression_level=None):
+    if compression_level is None:
+        sitk.WriteImage(image, path)
+    else:
+        sitk.WriteImage(image, path, True, compression_level)
+
+
+def reorient(root_path, path, compression_level=None):
+    print(path)
+    img_path, mask_path = get_input_paths(root_path, path)
+    img=sitk.ReadImage(img_path)
+    label = sitk.ReadImage(mask_path)
+    np_img = sitk.GetArrayViewFromImage(img)
+    np_mask = sitk.GetArrayViewFromImage(label) != 0
+
+    # single float32 pass: shift by the global minimum of the image inside the mask, 0 outside
+    np_out = np.zeros(np_img.shape, dtype=np.float32)
+    np.subtract(np_img, np_img.min(), out=np_out, where=np_mask, dtype=np.float32)
     spacing = img.GetSpacing()
-    image_shape = list(np_img.shape)
-    s1 = image_shape.index(min(image_shape))
-    s2 = image_shape.index(max(image_shape))
-    sp1 = spacing.index(max(spacing))
-    sp2 = spacing.index(min(spacing))
-    if s2==1:
-        T=s1, s2, s_list[s1 + s2 - 1]
-    elif s2==2:
-        T=s1, s_list[s1 + s2 - 1], s2
-    elif s2==0 and s1==1:
-        T=s1, s2, s_list[s1 + s2 - 1]
-    elif s2==0 and s1==2:
-        T=s1, s_list[s1 + s2 - 1], s2
-    np_img = np_img.transpose(T)
-    np_label = np_label.transpose(T)
+    T = get_permutation(np_img.shape)
     print(T)
-    im = sitk.GetImageFromArray(np_img.astype("float32"))
-    label = sitk.GetImageFromArray(np_label.astype("int16"))
-
-    # im = sitk.GetImageFromArray(mask)
-    if not os.path.exists(root_path.replace("image", "reo_image")):
-        os.makedirs(root_path.replace("image", "reo_image"),exist_ok=True)
-    if not os.path.exists(root_path.replace("image", "reo_mask")):
-        os.makedirs(root_path.replace("image", "reo_mask"),exist_ok=True)
+    im = sitk.GetImageFromArray(np_out)
+    del np_out
+    im.CopyInformation(img)
+    # the label keeps its pixel type and takes the geometry of the image
+    label.CopyInformation(img)
+
+    # permute the axes and the direction cosines natively
+    order = get_sitk_order(T)
+    im = sitk.PermuteAxes(im, order)
+    label = sitk.PermuteAxes(label, order)
+
     im.SetSpacing((min(spacing),min(spacing),max(spacing)))
     label.SetSpacing((min(spacing),min(spacing),max(spacing)))
+    im.SetOrigin(img.GetOrigin())
+    label.SetOrigin(img.GetOrigin())
+    out_img_path, out_mask_path = get_output_paths(root_path, path)
+    write_image(im, out_img_path, compression_level)
+    write_image(label, out_mask_path, compression_level)
+    return path
+
+
+def run(root_path='./data/image/', n_workers=1, compression_level=None, force=False, use_hash=False):
+    data_path_list = os.listdir(root_path)
+    os.makedirs(root_path.replace("image", "reo_image"), exist_ok=True)
+    os.makedirs(root_path.replace("image", "reo_mask"), exist_ok=True)
 
-    #
-    direction=img.GetDirection()
-    Origin=img.GetOrigin()
-    if T==(1,0,2):
-        direction_index[:, [1, 2]]=direction_index[:, [2, 1]]
-    elif T == (2,1,0):
-        direction_index[:, [0, 2]] = direction_index[:, [2, 0]]
-    elif T == (0,1,2):
-        pass
-    new_direction=(direction[direction_index[0,0]],direction[direction_index[0,1]],direction[direction_index[0,2]],
-                   direction[direction_index[1,0]],direction[direction_index[1,1]],direction[direction_index[1,2]],
-                   direction[direction_index[2,0]],direction[direction_index[2,1]],direction[direction_index[2,2]])
-    im.SetDirection(new_direction)
-    im.SetOrigin(Origin)
-    label.SetDirection(new_direction)
-    label.SetOrigin(Origin)
-    #
-    #
-    sitk.WriteImage(im, root_path.replace("image", "reo_image") + path)
-    sitk.WriteImage(label, root_path.replace("image", "reo_mask") + path)
+    # hashes of the inputs of the last reorientation, stored next to the image folder
+    hash_file = os.path.join(os.path.dirname(os.path.normpath(root_path)), "reorientation_hashes.json")
+    hashes = None
+    if use_hash:
+        hashes = {}
+        if os.path.exists(hash_file):
+            with open(hash_file) as f:
+                hashes = json.load(f)
+    todo = []
+    new_hashes = {}
+    for path in data_path_list:
+        in_paths = get_input_paths(root_path, path)
+        path_hash = get_hash(in_paths) if use_hash else None
+        new_hashes[path] = path_hash
+        if not force and is_up_to_date(in_paths, get_output_paths(root_path, path), hashes, path_hash):
+            print(path + " is up to date")
+            continue
+        todo.append(path)
 
+    def done(path):
+        if use_hash:
+            hashes[path] = new_hashes[path]
 
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(reorient, root_path, path, compression_level) for path in todo]
+            for future in as_completed(futures):
+                done(future.result())
+    else:
+        for path in todo:
+            done(reorient(root_path, path, compression_level))
+    if use_hash:
+        with open(hash_file, "w") as f:
+            json.dump(hashes, f, indent=1)
 
 
+if __name__ == '__main__':
+    os.chdir(sys.path[0])
+    parser = argparse.ArgumentParser(description='Reorient the images and masks so that the through-plane axis is last.')
+    parser.add_argument('--root_path', type=str, default='./data/image/',
+                        help='directory of the images, the masks are read from the sibling mask directory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes reorienting files in parallel')
+    parser.add_argument('--compression_level', type=int, default=None,
+                        help='gzip compression level of the output NIfTI files, defaults to the ITK default')
+    parser.add_argument('--force', action='store_true',
+                        help='reorient all files, including those whose outputs are up to date')
+    parser.add_argument('--hash', action='store_true',
+                        help='decide whether outputs are up to date from a hash of the inputs instead of mtimes')
+    args = parser.parse_args()
+    run(args.root_path, args.workers, args.compression_level, args.force, args.hash)
@@ -1,100 +1,218 @@
 import os
+import argparse
 import SimpleITK as sitk
 import torch
+import queue
+import threading
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from scipy.ndimage import distance_transform_edt as distance
-def get_label(label):
-    all_label = np.zeros((len(label), 2, label.shape[1], label.shape[2]))
-    for i in range(len(label)):
-        new_label = np.zeros((2, label.shape[1], label.shape[2]))
-
-        new_label[0] = label[i]
-        new_label[0][new_label[0] == 1] = 100
-        new_label[0][new_label[0] == 4] = 100
-        new_label[0][new_label[0] != 100] = 0
-        new_label[0][new_label[0] == 100] = 1
-
-        new_label[1] = label[i]
-        new_label[1][new_label[1] == 2] = 100
-        new_label[1][new_label[1] == 3] = 100
-        new_label[1][new_label[1] == 5] = 100
-        new_label[1][new_label[1] == 6] = 100
-        # new_label[1][new_label[1] == 7] = 100
-        new_label[1][new_label[1] != 100] = 0
-        new_label[1][new_label[1] == 100] = 1
-
-        all_label[i] = new_label
-    return all_label
-def get_high(im_tensor):
-    fft_src_np = torch.fft.fftn(im_tensor, dim=(-4, -3, -2, -1))
-    fshift = torch.fft.fftshift(fft_src_np).cuda()
-    np_zero = torch.ones_like(fshift).cuda()
+from unet.high_pass import high_pass
+# tissue labels merged into each binary channel of get_label
+LABEL_GROUPS = ((1, 4), (2, 3, 5, 6))
+def get_label(label, label_groups=LABEL_GROUPS, dtype=bool):
+    # binary channel per group of labels, stacked on axis 1: [N, H, W] -> [N, len(label_groups), H, W]
+    label = np.asarray(label)
+    if np.issubdtype(label.dtype, np.integer) and label.min() >= 0:
+        # lookup table from label value to channel memberships
+        lut = np.zeros((label.max() + 1, len(label_groups)), dtype=dtype)
+        for c, group in enumerate(label_groups):
+            lut[[l for l in group if l <= label.max()], c] = 1
+        return np.moveaxis(lut[label], -1, 1)
+    return np.stack([np.isin(label, group) for group in label_groups], axis=1).astype(dtype)
+def get_high(im_tensor, real=False):
     b=im_tensor.shape[2]//2
     c=im_tensor.shape[3]//2
     s_b = b //20
     s_c = c //20
-    np_zero[:, :, b - s_b:b + s_b, c - s_c:c + s_c] = 0
-    fshift = fshift * np_zero
-    ishift = torch.fft.ifftshift(fshift).cuda()
-    iimg = abs(torch.fft.ifftn(ishift, dim=(-4,-3, -2, -1)).cuda())
     # iimg=torch.cat((im_tensor,iimg),1)
-    return iimg
-def one_hot2dist(seg: np.ndarray) -> np.ndarray:
+    return high_pass(im_tensor, s_b, s_c, real)
+def one_hot2dist(seg: np.ndarray, sampling=None, n_workers=1) -> np.ndarray:
+    if n_workers > 1 and len(seg) > 1:
+        # chunks of classes computed in parallel processes
+        chunks = np.array_split(np.arange(len(seg)), min(n_workers, len(seg)))
+        res = np.zeros(seg.shape, dtype=np.float32)
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            for chunk, dist in zip(chunks, executor.map(one_hot2dist, [seg[chunk] for chunk in chunks],
+                                                        repeat(sampling))):
+                res[chunk] = dist
+        return res
     C: int = len(seg)
-    res = np.zeros_like(seg)
+    res = np.zeros(seg.shape, dtype=np.float32)
+    # one voxel inside the boundary has distance 0
+    offset = 1 if sampling is None else min(sampling)
     for c in range(C):
-        posmask = seg[c].astype(np.bool)
+        posmask = seg[c].astype(bool)
         if posmask.any():
             negmask = ~posmask
-            res[c] = distance(negmask) * negmask - (distance(posmask) - 1) * posmask
+            res[c] = np.where(posmask, offset - distance(posmask, sampling), distance(negmask, sampling))
     return res
-root_path="../data/reo_image"
-paths_list=os.listdir(root_path)
-model=torch.load("./save_0.05/U.pth").cuda()
-if not os.path.exists(root_path.replace("reo_image", "reo_label")):
-    os.makedirs(root_path.replace("reo_image", "reo_label"))
-if not os.path.exists(root_path.replace("reo_image", "distance")):
-    os.makedirs(root_path.replace("reo_image", "distance"))
-for path in paths_list:
-    path=os.path.join(root_path,path)
-    img_sitk=sitk.ReadImage(path)
-    np_img=sitk.GetArrayFromImage(img_sitk)
-    tensor_img=torch.tensor(np_img).unsqueeze(1).cuda()
+def get_distance_map(mask, spacing=None, label_groups=LABEL_GROUPS, n_workers=1):
+    # distance to the boundary of the first label group, computed slice by slice on the [z, y, x] mask
+    sampling = None if spacing is None else (spacing[1], spacing[0])
+    img = get_label(mask, label_groups)
+    dis_final = np.abs(one_hot2dist(img[:, 0], sampling, n_workers))
+    dis_max = dis_final.max()
+    np.subtract(dis_max, dis_final, out=dis_final)
+    dis_final /= dis_max
+    # zero the planes which are constant 1, along each axis in turn
+    ones = dis_final == 1
+    for axis in range(3):
+        planes = [slice(None)] * 3
+        planes[axis] = ones.all(axis=tuple(a for a in range(3) if a != axis))
+        dis_final[tuple(planes)] = 0
+        ones[tuple(planes)] = False
+    np.exp(dis_final, out=dis_final)
+    dis_final -= 1
+    np.exp(dis_final, out=dis_final)
+    dis_final -= 1
+    np.exp(dis_final, out=dis_final)
+    dis_final /= dis_final.max()
+    dis_final += 0.3
+    return dis_final
+def get_device(device=None):
+    if device is None:
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+def load_model(model_path, device):
+    # eval mode: BatchNorm uses its running statistics, so the labels do not depend on the slice batching
+    return torch.load(model_path, map_location=device).eval()
+def get_batch_size(slice_shape, memory_budget=None, activations_per_pixel=256):
+    # number of slices per forward pass fitting into memory_budget (MB), all slices if no budget is given
+    if memory_budget is None:
+        return None
+    bytes_per_slice = slice_shape[0] * slice_shape[1] * activations_per_pixel * 4
+    return max(1, int(memory_budget * 1024 ** 2 // bytes_per_slice))
+def segment(model, np_img, device, memory_budget=None, real_fft=False):
+    tensor_img=torch.tensor(np_img).unsqueeze(1).to(device)
     tensor_img=(tensor_img-tensor_img.min())/(tensor_img.max()-tensor_img.min())
-    tensor_img=get_high(tensor_img)
-    pre_img,_=model(tensor_img)
-    res = pre_img.detach().cpu().numpy()
-    mask = np.argmax(res, axis=1)
+    batch_size = get_batch_size(np_img.shape[1:], memory_budget)
+    if batch_size is None:
+        batch_size = len(tensor_img)
+    mask = []
+    with torch.inference_mode():
+        for start in range(0, len(tensor_img), batch_size):
+            # the high-pass filter acts on each slice independently, so it can be applied per batch
+            pre_img,_=model(get_high(tensor_img[start:start + batch_size], real_fft))
+            mask.append(torch.argmax(pre_img, dim=1).cpu())
+    mask = torch.cat(mask).numpy()
     mask = np.squeeze(mask)
     mask = mask + 1
     mask[mask == 7] = 0
+    return mask
+def make_output_dirs(root_path):
+    if not os.path.exists(root_path.replace("reo_image", "reo_label")):
+        os.makedirs(root_path.replace("reo_image", "reo_label"))
+    if not os.path.exists(root_path.replace("reo_image", "distance")):
+        os.makedirs(root_path.replace("reo_image", "distance"))
+def write_label(path, mask, img_sitk):
     label = sitk.GetImageFromArray(mask.astype("int16"))
     label.CopyInformation(img_sitk)
     sitk.WriteImage(label,path.replace("reo_image","reo_label"))
+def write_distance(path, dis_final, img_sitk):
+    label = sitk.GetImageFromArray(dis_final)
+    label.CopyInformation(img_sitk)
+    sitk.WriteImage(label, path.replace("reo_image", "distance"))
+def run(root_path="../data/reo_image", model_path="./save_0.05/U.pth", device=None, memory_budget=None,
+        label_groups=LABEL_GROUPS, dist_workers=1, real_fft=False):
+    paths_list=os.listdir(root_path)
+    device = get_device(device)
+    model = load_model(model_path, device)
+    make_output_dirs(root_path)
+    for path in paths_list:
+        path=os.path.join(root_path,path)
+        img_sitk=sitk.ReadImage(path)
+        np_img=sitk.GetArrayFromImage(img_sitk)
+        mask = segment(model, np_img, device, memory_budget, real_fft)
+        write_label(path, mask, img_sitk)
 
-
-    img = get_label(mask)
-    dis_final = np.zeros_like(mask).astype("float64")
-    for j in range(1):
-        dis_label = abs(one_hot2dist(img[:, j]))
-        img_label = mask.copy()
-        dis_label_boundary = (dis_label.max() - dis_label) / dis_label.max()
-        for i in range(mask.shape[0]):
-            if dis_label_boundary[i].sum() == dis_label_boundary.shape[1] * dis_label_boundary.shape[2]:
-                dis_label_boundary[i] = 0
-        for i in range(mask.shape[1]):
-            if dis_label_boundary[:, i].sum() == dis_label_boundary.shape[0] * dis_label_boundary.shape[2]:
-                dis_label_boundary[:, i] = 0
-        for i in range(mask.shape[2]):
-            if dis_label_boundary[:, :, i].sum() == dis_label_boundary.shape[1] * dis_label_boundary.shape[0]:
-                dis_label_boundary[:, :, i] = 0
-        # dis_label_boundary[img_label == 0] = 0
-        dis_final += dis_label_boundary
-        # dis_final = dis_final/2
-        # dis_final = np.exp(np.exp(dis_final) - 1)
-        dis_final = np.exp(np.exp(np.exp(dis_final) - 1) - 1)
-        dis_final = dis_final / dis_final.max() + 0.3
-
-        label = sitk.GetImageFromArray(dis_final)
-        label.CopyInformation(img_sitk)
-        sitk.WriteImage(label, path.replace("reo_image", "distance"))
\ No newline at end of file
+        dis_final = get_distance_map(mask, img_sitk.GetSpacing(), label_groups, dist_workers)
+        write_distance(path, dis_final, img_sitk)
+def _read_images(paths_list, read_queue, stop):
+    # reader stage: prefetch the images, None marks the end of the stream
+    try:
+        for path in paths_list:
+            if stop.is_set():
+                break
+            img_sitk=sitk.ReadImage(path)
+            read_queue.put((path, img_sitk, sitk.GetArrayFromImage(img_sitk)))
+    finally:
+        read_queue.put(None)
+def _write_images(write_queue):
+    # writer stage: keeps draining the queue after an error, so that the other stages never block on it
+    error = None
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        if error is not None:
+            continue
+        try:
+            path, img_sitk, mask, dis_future = item
+            write_label(path, mask, img_sitk)
+            write_distance(path, dis_future.result(), img_sitk)
+        except Exception as e:
+            error = e
+    if error is not None:
+        raise error
+def run_streaming(root_path="../data/reo_image", model_path="./save_0.05/U.pth", device=None, memory_budget=None,
+                  label_groups=LABEL_GROUPS, dist_workers=1, queue_size=2, real_fft=False):
+    # pipelined version of run: reader thread -> segmentation -> distance process pool -> writer thread,
+    # with bounded queues between the stages
+    paths_list=[os.path.join(root_path, path) for path in os.listdir(root_path)]
+    device = get_device(device)
+    model = load_model(model_path, device)
+    make_output_dirs(root_path)
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as threads, ProcessPoolExecutor(max_workers=dist_workers) as processes:
+        reader = threads.submit(_read_images, paths_list, read_queue, stop)
+        writer = threads.submit(_write_images, write_queue)
+        done = False
+        try:
+            while True:
+                item = read_queue.get()
+                if item is None:
+                    done = True
+                    break
+                path, img_sitk, np_img = item
+                mask = segment(model, np_img, device, memory_budget, real_fft)
+                dis_future = processes.submit(get_distance_map, mask, img_sitk.GetSpacing(), label_groups)
+                write_queue.put((path, img_sitk, mask, dis_future))
+        finally:
+            write_queue.put(None)
+            if not done:
+                stop.set()
+                while read_queue.get() is not None:
+                    pass
+        reader.result()
+        writer.result()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run tissue segmentation and distance map generation.')
+    parser.add_argument('--root_path', type=str, default="../data/reo_image",
+                        help='directory of the reoriented images to be segmented')
+    parser.add_argument('--model', type=str, default="./save_0.05/U.pth",
+                        help='trained UNet to be loaded')
+    parser.add_argument('--device', type=str, default=None,
+                        help='device to run the UNet on, e.g. cpu or cuda:0. Defaults to cuda if available')
+    parser.add_argument('--memory_budget', type=float, default=None,
+                        help='approximate memory in MB per forward pass, used to batch the slices. '
+                             'Defaults to the whole volume at once')
+    parser.add_argument('--dist_workers', type=int, default=1,
+                        help='number of processes used to compute the distance maps '
+                             '(per subject with --streaming, per slice chunk otherwise)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='overlap reading, segmentation, distance maps and writing across subjects')
+    parser.add_argument('--queue_size', type=int, default=2,
+                        help='number of subjects buffered between the stages of the streaming runner')
+    parser.add_argument('--real_fft', action='store_true',
+                        help='use rfft2 for the high-pass filter, with the symmetric version of the frequency window')
+    args = parser.parse_args()
+    if args.streaming:
+        run_streaming(args.root_path, args.model, args.device, args.memory_budget,
+                      dist_workers=args.dist_workers, queue_size=args.queue_size, real_fft=args.real_fft)
+    else:
+        run(args.root_path, args.model, args.device, args.memory_budget, dist_workers=args.dist_workers,
+            real_fft=args.real_fft)
@@ -1,2 +1,2 @@
 from .unet_model import UNet
-
+from .high_pass import high_pass
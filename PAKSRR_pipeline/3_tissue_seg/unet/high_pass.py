@@ -0,0 +1,47 @@
+""" FFT high-pass filter applied to the UNet input slices """
+
+import torch
+
+# frequency masks, keyed on (H, W, s_b, s_c, real, device)
+_masks = {}
+
+
+def get_high_pass_mask(shape, s_b, s_c, real=False, device=None):
+    """Mask zeroing the low frequencies, in the unshifted layout of fft2 (or rfft2 if real)"""
+    H, W = shape
+    key = (H, W, s_b, s_c, real, str(device))
+    if key not in _masks:
+        if real:
+            # rfft2 needs a Hermitian-symmetric mask: zero |k_H| <= s_b and |k_W| <= s_c
+            mask = torch.ones(H, W // 2 + 1)
+            rows = torch.arange(-s_b, s_b + 1) % H
+            cols = torch.arange(0, s_c + 1)
+        else:
+            # same window as zeroing [H//2 - s_b, H//2 + s_b) x [W//2 - s_c, W//2 + s_c) after fftshift
+            mask = torch.ones(H, W)
+            rows = torch.arange(-s_b, s_b) % H
+            cols = torch.arange(-s_c, s_c) % W
+        if s_b > 0 and s_c > 0:
+            mask[rows[:, None], cols[None, :]] = 0
+        _masks[key] = mask.to(device)
+    return _masks[key]
+
+
+def high_pass(im_tensor, s_b, s_c, real=False):
+    """
+    High-pass filter each [H, W] slice of a [N, C, H, W] tensor, in float32.
+    The low frequencies within s_b and s_c of zero are removed and the magnitude of the result is returned.
+    The transform runs over the two spatial axes only, which is equivalent to the former 4-D fftn since the mask
+    does not depend on the batch and channel frequencies.
+    If real, rfft2 is used with the symmetric version of the window, which also zeroes the frequencies +s_b and +s_c.
+    """
+    im_tensor = im_tensor.float()
+    shape = im_tensor.shape[-2:]
+    mask = get_high_pass_mask(shape, s_b, s_c, real, im_tensor.device)
+    if real:
+        spectrum = torch.fft.rfft2(im_tensor)
+        spectrum *= mask
+        return torch.fft.irfft2(spectrum, s=shape).abs_()
+    spectrum = torch.fft.fft2(im_tensor)
+    spectrum *= mask
+    return torch.fft.ifft2(spectrum).abs()
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import numpy as np
 import SimpleITK as sitk
 from .unet_parts import *
+from .high_pass import high_pass
 class UNet(nn.Module):
     def __init__(self, n_channels=1, n_classes=7, bilinear=True):
         super(UNet, self).__init__()
@@ -39,10 +40,7 @@ class UNet(nn.Module):
     #     ishift = torch.fft.ifftshift(fshift).cuda()
     #     iimg = abs(torch.fft.ifftn(ishift, dim=(-4, -3, -2, -1)).cuda())
     #     return iimg
-    def get_high(self,im_tensor):
-        fft_src_np = torch.fft.fftn(im_tensor, dim=(-4, -3, -2, -1))
-        fshift = torch.fft.fftshift(fft_src_np)
-        np_zero = torch.ones_like(fshift)
+    def get_high(self,im_tensor,real=False):
         b = im_tensor.shape[2]//2
         c = im_tensor.shape[3]//2
         s_b = b//20
@@ -50,11 +48,7 @@ class UNet(nn.Module):
         if s_b == 0:
             s_b = 1
             s_c = 1
-        np_zero[:, :, b - s_b:b + s_b, c - s_c:c + s_c] = 0
-        fshift = fshift * np_zero
-        ishift = torch.fft.ifftshift(fshift)
-        iimg = abs(torch.fft.ifftn(ishift, dim=(-4, -3, -2, -1)))
-        return iimg
+        return high_pass(im_tensor, s_b, s_c, real)
 
     def forward(self, x):
         x1 = self.inc(x)
@@ -38,6 +38,7 @@ parser.add_argument("--slice_thicknesses", default=None)
 parser.add_argument("--boundary_stacks", default=[10, 10, 0])
 parser.add_argument("--bias_field_correction", default=True)
 parser.add_argument("--target_stack_index", default=0)
+parser.add_argument("--target_score", default="overlap")
 parser.add_argument("--isotropic_resolution", default=0.8)
 parser.add_argument("--extra_frame_target", default=10)
 parser.add_argument("--metric", default="Correlation")
@@ -60,16 +61,28 @@ parser.add_argument("--outlier_rejection", default=1)
 parser.add_argument("--out_path", default=out_path)
 parser.add_argument("--reconstruction_type", default="TK1L2")
 parser.add_argument("--dilation_radius", default=3)
+parser.add_argument("--s2v_optimizer", default="gradient_ascent")
+parser.add_argument("--s2v_iter_max", type=int, default=100)
+parser.add_argument("--s2v_tolerance", type=float, default=1e-6)
+parser.add_argument("--s2v_workers", type=int, default=1)
+parser.add_argument("--use_sparse_operator", action="store_true")
+parser.add_argument("--use_weighted_operator", action="store_true")
+parser.add_argument("--atlas_update", default="always")
+parser.add_argument("--atlas_workers", type=int, default=1)
+parser.add_argument("--atlas_threads", type=int, default=None)
+parser.add_argument("--atlas_winning_direction", action="store_true")
+parser.add_argument("--warm_start", action="store_true")
+parser.add_argument("--lsmr_atol", type=float, default=0)
+parser.add_argument("--lsmr_btol", type=float, default=0)
 rejection_measure = "NCC"
 args = parser.parse_args()
 
 # ------------------------Volume-to-Volume Registration--------------------
-stacks=data_process(args)
-args.target_stack_index=target_select(stacks)
+stacks, stacks_dis = joint_data_process(args)
+args.target_stack_index=target_select(stacks, score=args.target_score)
 
 
 reference = Stack.from_stack(stacks[args.target_stack_index])
-stacks_dis=dis_data_process(args)
 reference_dis = Stack.from_stack(stacks_dis[args.target_stack_index])
 vol_registration = niftyreg.RegAladin(
                 registration_type="Rigid",
@@ -172,13 +185,29 @@ HR_volume = SDA.get_reconstruction()
 #
 #         )
 from slice2volume import S2V
-registration = S2V(moving=HR_volume,fixed=None,dis=None)
+atlas_prior = tk.AtlasPrior(
+    args.atlas_path,
+    update=args.atlas_update,
+    n_workers=args.atlas_workers,
+    n_threads=args.atlas_threads,
+    use_winning_direction=args.atlas_winning_direction,
+)
+registration = S2V(
+    moving=HR_volume,
+    fixed=None,
+    dis=None,
+    optimizer=args.s2v_optimizer,
+    iter_max=args.s2v_iter_max,
+    tolerance=args.s2v_tolerance,
+    shrink_factors=args.shrink_factors if int(args.multiresolution) else None,
+    smoothing_sigmas=args.smoothing_sigmas if int(args.multiresolution) else None,
+)
 
 recon_method = tk.TikhonovSolver(
                 stacks=stacks,
                 stacks_dis=stacks_dis,
                 reconstruction=HR_volume,
-                atlas=args.atlas_path,
+                atlas=atlas_prior,
                 reg_type="TK1",
                 minimizer="lsmr",
                 # minimizer="least_squares",
@@ -186,6 +215,11 @@ recon_method = tk.TikhonovSolver(
                 iter_max=np.min([args.iter_max_first, args.iter_max]),
                 verbose=True,
                 use_masks=args.use_masks_srr,
+                use_sparse_operator=args.use_sparse_operator,
+                use_weighted_operator=args.use_weighted_operator,
+                warm_start=args.warm_start,
+                atol=args.lsmr_atol,
+                btol=args.lsmr_btol,
             )
 alpha_range = [args.alpha_first, args.alpha]
 alphas = np.linspace(
@@ -210,6 +244,7 @@ two_step_s2v_reg_recon = \
         interleave=args.interleave,
         viewer=args.viewer,
         verbose=ep,
+        n_workers=args.s2v_workers,
     )
 two_step_s2v_reg_recon.run()
 HR_volume_iterations = \
@@ -222,9 +257,14 @@ recon_method = tk.TikhonovSolver(
     stacks=stacks,
     stacks_dis=stacks_dis,
     reconstruction=HR_volume,
-    atlas=args.atlas_path,
+    atlas=atlas_prior,
     reg_type="TK1" if args.reconstruction_type == "TK1L2" else "TK0",
     use_masks=args.use_masks_srr,
+    use_sparse_operator=args.use_sparse_operator,
+    use_weighted_operator=args.use_weighted_operator,
+    warm_start=args.warm_start,
+    atol=args.lsmr_atol,
+    btol=args.lsmr_btol,
 )
 recon_method.set_alpha(args.alpha)
 recon_method.set_index(ep)
@@ -43,59 +43,68 @@ def data_process(args):
 
 
 
-def dis_data_process(args):
-    data_reader = dr.MultipleImagesReader(
-        file_paths=args.dis_filenames,
-        file_paths_masks=args.filenames_masks,
-        suffix_mask=args.suffix_mask,
-        stacks_slice_thicknesses=args.slice_thicknesses,
-    )
-    data_reader.read_data()
-    stacks = data_reader.get_data()
-    segmentation_propagator = segprop.SegmentationPropagation(
-        dilation_radius=args.dilation_radius,
-        dilation_kernel="Ball",
-    )
-    data_preprocessing = dp.DataPreprocessing(
-        stacks=stacks,
-        segmentation_propagator=segmentation_propagator,
-        use_cropping_to_mask=True,
-        use_N4BiasFieldCorrector=False,
-        target_stack_index=args.target_stack_index,
-        boundary_i=args.boundary_stacks[0],
-        boundary_j=args.boundary_stacks[1],
-        boundary_k=args.boundary_stacks[2],
-        unit="mm",
-    )
-    data_preprocessing.run()
-    stacks = data_preprocessing.get_preprocessed_stacks()
-
-    return stacks
-
-
-def target_select(stacks):
-    target_index=-1
-    max_overlap=0
-    for i in range(len(stacks)):
-        stack=sitk.GetArrayFromImage(stacks[i].sitk_mask)
-        stack[stack!=0]=1
-        overlap=0
-        for j in range(stack.shape[0]-1):
-            overlap+=(stack[j]*stack[j+1]).sum()
-        if overlap>max_overlap:
-            max_overlap=overlap
-            target_index+=1
-    return target_index
-
-
-
-
-
-
-
-
-
-
-
-
-
+##
+# Read image, mask and distance-map stacks in a single pass.
+#
+# Masks are read once and segmentation propagation, cropping and bias field
+# correction run on the intensity stacks only. The distance maps live on
+# the same grid as the images, so each is cropped by resampling it onto its
+# preprocessed stack, i.e. both share geometry by construction.
+#
+def joint_data_process(args):
+    stacks = data_process(args)
+
+    stacks_dis = []
+    for stack, dis_filename in zip(stacks, args.dis_filenames):
+        dis_sitk = sitk.ReadImage(dis_filename, sitk.sitkFloat64)
+        dis_sitk = sitk.Resample(
+            dis_sitk,
+            stack.sitk,
+            sitk.Euler3DTransform(),
+            sitk.sitkNearestNeighbor,
+            0.,
+            dis_sitk.GetPixelIDValue(),
+        )
+        stacks_dis.append(Stack.from_sitk_image(
+            image_sitk=dis_sitk,
+            slice_thickness=stack.get_slice_thickness(),
+            filename=stack.get_filename(),
+            image_sitk_mask=stack.sitk_mask,
+        ))
+    return stacks, stacks_dis
+
+
+def overlap_score(mask):
+    # Overlap of all adjacent slice pairs
+    return np.count_nonzero(mask[:-1] & mask[1:])
+
+
+def volume_score(mask):
+    return np.count_nonzero(mask)
+
+
+def motion_score(mask):
+    # Mean Jaccard index of adjacent slices, i.e. 1 for a motion-free stack
+    intersection = (mask[:-1] & mask[1:]).sum(axis=(1, 2))
+    union = (mask[:-1] | mask[1:]).sum(axis=(1, 2))
+    valid = union > 0
+    if not valid.any():
+        return 0
+    return (intersection[valid] / union[valid]).mean()
+
+
+TARGET_SCORES = {
+    "overlap": overlap_score,
+    "volume": volume_score,
+    "motion": motion_score,
+}
+
+
+def target_select(stacks, score="overlap"):
+    if not callable(score):
+        if score not in TARGET_SCORES:
+            raise ValueError("Target score must be in " + str(list(TARGET_SCORES)))
+        score = TARGET_SCORES[score]
+    scores = [score(sitk.GetArrayViewFromImage(stack.sitk_mask) != 0)
+              for stack in stacks]
+    return int(np.argmax(scores))
@@ -9,11 +9,15 @@ import nsol.linear_operators as linop
 import pysitk.python_helper as ph
 import pysitk.simple_itk_helper as sitkh
 import datetime
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from abc import ABCMeta, abstractmethod
 from skimage.exposure import match_histograms
 import os
 import sys
 import scipy
+import scipy.sparse
 
 # from nsol.linear_solver import LinearSolver
 from nsol.definitions import EPS
@@ -23,6 +27,43 @@ import least_square
 # Allowed data loss functions
 DATA_LOSS = ['linear', 'soft_l1', 'huber', 'cauchy', 'arctan']
 
+# Allowed update strategies of the atlas prior across SRR cycles
+ATLAS_UPDATE = ['always', 'refine', 'once']
+
+
+##
+# Set the number of threads used by ANTs. ANTsPy has no thread setter and
+# its ITK reads the variable only once, when its thread pool is first set
+# up. It must therefore be set before the first ANTs call of the process;
+# forked workers inherit the pool sized accordingly.
+#
+def _set_ants_threads(n_threads):
+    if n_threads is not None:
+        os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(int(n_threads))
+
+
+##
+# Run one ANTs registration on images given as (array, origin, spacing,
+# direction) tuples, so that jobs can be sent to worker processes.
+#
+# \param      output  key of the warped image to return, i.e.
+#                     'warpedmovout' or 'warpedfixout'
+#
+# \return     dict with the warped image array and the transform files
+#
+def _ants_registration(fixed, moving, kwargs, output):
+    outs = ants.registration(
+        ants.from_numpy(fixed[0], origin=fixed[1], spacing=fixed[2],
+                        direction=fixed[3]),
+        ants.from_numpy(moving[0], origin=moving[1], spacing=moving[2],
+                        direction=moving[3]),
+        **kwargs)
+    return {
+        "warped": outs[output].numpy(),
+        "fwdtransforms": outs["fwdtransforms"],
+        "invtransforms": outs["invtransforms"],
+    }
+
 import os
 import sys
 from abc import ABCMeta, abstractmethod
@@ -174,6 +215,225 @@ class LinearSolver(solv):
 
 
 
+##
+# Atlas prior of the Tikhonov regularizer, i.e. the atlas non-rigidly
+# registered to the current reconstruction.
+#
+# Results are cached on the reconstruction grid and a hash of the masked
+# reconstruction. Across SRR cycles the registration found first can be
+# reused depending on update:
+#   "always": register from scratch every time
+#   "refine": register once, then only run the deformable stage starting
+#             from the previously found affine transform
+#   "once":   register once, then only resample the atlas with the found
+#             transforms
+#
+# Both candidate registrations (atlas->recon and recon->atlas) can run
+# concurrently in n_workers processes. n_threads sets the ITK threads used
+# by ANTs, on the serial path as well as in the workers; it is applied at
+# construction, so the prior must be created before any other ANTs call.
+# With use_winning_direction, only the direction that won the first
+# registration is run afterwards.
+# \date       2026-10-17
+#
+class AtlasPrior(object):
+
+    def __init__(self,
+                 atlas,
+                 update="always",
+                 type_of_transform="SyN",
+                 n_workers=1,
+                 n_threads=None,
+                 use_winning_direction=False,
+                 ):
+        if update not in ATLAS_UPDATE:
+            raise ValueError("Atlas update must be in " + str(ATLAS_UPDATE))
+        self._atlas = atlas
+        self._update = update
+        self._type_of_transform = type_of_transform
+        self._n_workers = int(n_workers)
+        self._n_threads = n_threads
+        _set_ants_threads(n_threads)
+        self._use_winning_direction = use_winning_direction
+
+        self._atlas_ants = None
+        self._cache = {}
+
+        # Transforms of the first registration, per direction
+        # (atlas->recon, recon->atlas), and the index of the winning one
+        self._transforms = None
+        self._affine_transforms = None
+        self._direction = None
+
+    def get_atlas(self):
+        return self._atlas
+
+    def set_update(self, update):
+        if update not in ATLAS_UPDATE:
+            raise ValueError("Atlas update must be in " + str(ATLAS_UPDATE))
+        self._update = update
+
+    def get_update(self):
+        return self._update
+
+    ##
+    # Get the atlas warped to the reconstruction space.
+    #
+    # \param      reconstruct_x  reconstruction as Stack object
+    #
+    # \return     warped atlas as numpy array of the reconstruction shape
+    #
+    def get_warped_atlas(self, reconstruct_x):
+        rec=sitk.GetArrayFromImage(reconstruct_x.sitk)
+        rec_m=sitk.GetArrayFromImage(reconstruct_x.sitk_mask)
+        rec[rec_m==0]=0
+
+        key = self._get_key(rec, reconstruct_x.sitk)
+        if key in self._cache:
+            ph.print_info("Atlas prior: reuse cached registration")
+            return self._cache[key]
+
+        move_img = self._get_ants_image(rec, reconstruct_x.sitk)
+        fix_img = self._get_atlas_ants()
+
+        if self._transforms is not None and self._update == "once":
+            transformlist, whichtoinvert = self._transforms[self._direction]
+            reg_img = ants.apply_transforms(
+                fixed=move_img,
+                moving=fix_img,
+                transformlist=transformlist,
+                whichtoinvert=whichtoinvert,
+            ).numpy()
+        else:
+            reg_img = self._register(fix_img, move_img)
+
+        # ANTs arrays are indexed (x, y, z), SimpleITK ones (z, y, x)
+        out = reg_img.T
+
+        self._cache[key] = out
+        return out
+
+    def _get_key(self, rec, reconstruction_sitk):
+        return (
+            reconstruction_sitk.GetSize(),
+            reconstruction_sitk.GetSpacing(),
+            reconstruction_sitk.GetOrigin(),
+            reconstruction_sitk.GetDirection(),
+            hashlib.sha1(np.ascontiguousarray(rec).tobytes()).hexdigest(),
+        )
+
+    ##
+    # Convert a SimpleITK image, given as array plus geometry, to an ANTs
+    # image in memory.
+    #
+    # \param      nda            numpy array in SimpleITK (z, y, x) order
+    # \param      image_sitk     SimpleITK image defining the geometry
+    #
+    @staticmethod
+    def _get_ants_image(nda, image_sitk):
+        dim = image_sitk.GetDimension()
+        return ants.from_numpy(
+            np.ascontiguousarray(nda.T, dtype=np.float32),
+            origin=image_sitk.GetOrigin(),
+            spacing=image_sitk.GetSpacing(),
+            direction=np.array(image_sitk.GetDirection()).reshape(dim, dim),
+        )
+
+    def _get_atlas_ants(self):
+        if self._atlas_ants is None:
+            self._atlas_ants = ants.image_read(self._atlas)
+        return self._atlas_ants
+
+    ##
+    # Register atlas and reconstruction in both directions (or only in the
+    # winning one) and keep the candidate closer to the reconstruction.
+    #
+    # \return     warped atlas as numpy array in ANTs (x, y, z) order
+    #
+    def _register(self, fix_img, move_img):
+        if self._affine_transforms is not None and self._update == "refine":
+            # Warm start: deformable stage only, from the previous affine
+            kwargs = [
+                dict(type_of_transform="SyNOnly", initial_transform=affine)
+                for affine in self._affine_transforms]
+        else:
+            kwargs = [dict(type_of_transform=self._type_of_transform)] * 2
+
+        # 配准
+        fix = self._get_array_tuple(fix_img)
+        move = self._get_array_tuple(move_img)
+        jobs = [
+            (fix, move, kwargs[0], 'warpedfixout'),
+            (move, fix, kwargs[1], 'warpedmovout'),
+        ]
+        directions = [0, 1]
+        if self._use_winning_direction and self._direction is not None:
+            directions = [self._direction]
+
+        if self._n_workers > 1 and len(directions) > 1:
+            # Fork, since spawned workers would re-run the unguarded main
+            # script on import
+            with ProcessPoolExecutor(
+                    max_workers=min(self._n_workers, len(directions)),
+                    mp_context=multiprocessing.get_context("fork"),
+            ) as executor:
+                outs = list(executor.map(
+                    _ants_registration, *zip(*[jobs[d] for d in directions])))
+        else:
+            outs = [_ants_registration(*jobs[d]) for d in directions]
+
+        # 获取配准后的数据
+        if len(directions) > 1:
+            reg_img, direction = self.get_correlation(
+                move_img.numpy(), outs[0]['warped'], outs[1]['warped'])
+        else:
+            direction = directions[0]
+            reg_img = outs[0]['warped']
+
+        if self._transforms is None:
+            outs_1, outs_2 = outs
+            invtransforms = outs_1['invtransforms']
+            self._transforms = [
+                (invtransforms, [True] + [False] * (len(invtransforms) - 1)),
+                (outs_2['fwdtransforms'], [False] * len(outs_2['fwdtransforms'])),
+            ]
+            self._affine_transforms = [
+                outs_1['fwdtransforms'][-1], outs_2['fwdtransforms'][-1]]
+            self._direction = direction
+
+        return reg_img
+
+    @staticmethod
+    def _get_array_tuple(image_ants):
+        return (image_ants.numpy(), image_ants.origin, image_ants.spacing,
+                image_ants.direction)
+
+    ##
+    # Pick the candidate with the higher NCC to the reconstruction.
+    #
+    # \param      I  reconstruction, numpy array
+    # \param      J  atlas warped by the atlas->recon registration
+    # \param      K  atlas warped by the recon->atlas registration
+    #
+    # \return     warped atlas array and index of the chosen candidate
+    #
+    def get_correlation(self, I, J, K):
+        u = I.reshape(-1, 1)
+        v = J.reshape(-1, 1)
+        u = u - u.mean(keepdims=True)
+        v = v - v.mean(keepdims=True)
+        NCC_1 = np.mean((np.multiply(u, v)) / (np.std(u) * (np.std(v))))
+
+        w = K.reshape(-1, 1)
+        w = w - w.mean(keepdims=True)
+        NCC_2 = np.mean((np.multiply(u, w)) / (np.std(u) * (np.std(w))))
+
+        if NCC_1>=NCC_2:
+            return J, 0
+        else:
+            return K, 1
+
+
 class Solver(object):
     __metaclass__ = ABCMeta
 
@@ -195,12 +455,16 @@ class Solver(object):
                  verbose,
                  image_type=itk.Image.D3,
                  use_masks=True,
+                 use_sparse_operator=False,
+                 use_weighted_operator=False,
                  ):
 
         # Initialize variables
         self._stacks = stacks
         self._stacks_dis = stacks_dis
         self._reconstruction = reconstruction
+        if not isinstance(atlas, AtlasPrior):
+            atlas = AtlasPrior(atlas)
         self.atlas = atlas
 
         # Cut-off distance for Gaussian blurring filter
@@ -221,6 +485,22 @@ class Solver(object):
 
         self._use_masks = use_masks
 
+        # Precomputed sparse system matrix M A, assembled on demand and
+        # reused until the slice transforms change
+        self._use_sparse_operator = use_sparse_operator
+        if use_sparse_operator and deconvolution_mode != "full_3D":
+            raise ValueError(
+                "Sparse operator is only available for deconvolution mode "
+                "'full_3D'")
+        self._MA_sparse = None
+        self._MA_sparse_key = None
+
+        # Distance-map slices flattened once into a single weight vector W.
+        # In weighted-operator mode W is applied in the adjoint as well, so
+        # that the operator A^T M W is the true adjoint of W M A.
+        self._use_weighted_operator = use_weighted_operator
+        self._slices_dis_vec = None
+
         self._minimizer = minimizer
         self._data_loss = data_loss
         self._data_loss_scale = data_loss_scale
@@ -268,6 +548,7 @@ class Solver(object):
 
     def set_stacks(self, stacks):
         self._stacks = stacks
+        self._slices_dis_vec = None
 
         # Update helpers
         self._N_stacks = len(self._stacks)
@@ -280,6 +561,13 @@ class Solver(object):
 
     def set_use_masks(self, use_masks):
         self._use_masks = use_masks
+        self._MA_sparse = None
+
+    def set_use_sparse_operator(self, use_sparse_operator):
+        self._use_sparse_operator = use_sparse_operator
+
+    def set_use_weighted_operator(self, use_weighted_operator):
+        self._use_weighted_operator = use_weighted_operator
 
     def set_reconstruction(self, reconstruction):
         self._reconstruction = reconstruction
@@ -353,9 +641,19 @@ class Solver(object):
         return self._computational_time
 
     def get_A(self):
+        if self._use_sparse_operator:
+            MA = self._get_sparse_operator()
+            dis = self._get_slices_dis_vec()
+            return lambda x: dis * MA.dot(x)
         return lambda x: self._MA(x)
 
     def get_A_adj(self):
+        if self._use_sparse_operator:
+            MA = self._get_sparse_operator()
+            if self._use_weighted_operator:
+                dis = self._get_slices_dis_vec()
+                return lambda x: MA.T.dot(dis * x)
+            return lambda x: MA.T.dot(x)
         return lambda x: self._A_adj_M(x)
 
     def get_b(self):
@@ -390,8 +688,6 @@ class Solver(object):
         i_min = 0
         for i, stack in enumerate(self._stacks):
             slices = stack.get_slices()
-            stacks_dis=self._stacks_dis[i]
-            slices_dis = stacks_dis.get_slices()
             N_slice_voxels = np.array(slices[0].sitk.GetSize()).prod()
             for j, slice_j in enumerate(slices):
                 i_max = i_min + N_slice_voxels
@@ -401,11 +697,27 @@ class Solver(object):
                 else:
                     slice_itk = slice_j.itk
                 slice_nda_vec = self._itk2np.GetArrayFromImage(slice_itk).flatten()
-                slice_nda_vec_dis = self._itk2np.GetArrayFromImage(slices_dis[j].itk).flatten()
 
-                My[i_min:i_max] = slice_nda_vec*slice_nda_vec_dis
+                My[i_min:i_max] = slice_nda_vec
                 i_min = i_max
-        return My
+        return My * self._get_slices_dis_vec()
+
+    ##
+    # Get the distance-map slices of all stacks as one contiguous vector,
+    # ordered like the stacked slices. Computed once and reused by all
+    # operator evaluations.
+    # \date       2026-10-17
+    #
+    def _get_slices_dis_vec(self):
+        if self._slices_dis_vec is None:
+            dis = []
+            for i, stack in enumerate(self._stacks):
+                slices_dis = self._stacks_dis[i].get_slices()
+                for j in range(len(stack.get_slices())):
+                    dis.append(sitk.GetArrayFromImage(
+                        slices_dis[j].sitk).flatten())
+            self._slices_dis_vec = np.concatenate(dis)
+        return self._slices_dis_vec
 
 
 
@@ -464,8 +776,6 @@ class Solver(object):
 
         for i, stack in enumerate(self._stacks):
             slices = stack.get_slices()
-            stack_dis=self._stacks_dis[i]
-            slices_dis=stack_dis.get_slices()
             # Get number of voxels of each slice in current stack
             N_slice_voxels = np.array(slices[0].sitk.GetSize()).prod()
 
@@ -479,20 +789,24 @@ class Solver(object):
                 slice_itk = self._Mk_Ak(x_itk, slice_j)
 
                 slice_nda = self._itk2np.GetArrayFromImage(slice_itk)
-                # slice_nda = self.refine_s2v(slice_itk,slices_dis[j].itk,slice_j)
-                slice_nda_dis = self._itk2np.GetArrayFromImage(slices_dis[j].itk)
 
                 # Fill corresponding elements
-                MA_x[i_min:i_max] = slice_nda.flatten()*slice_nda_dis.flatten()
+                MA_x[i_min:i_max] = slice_nda.flatten()
 
                 # Define index for first voxel to specify subsequent slice
                 # (inclusive)
                 i_min = i_max
 
-        return MA_x
+        # Apply distance weights W
+        return MA_x * self._get_slices_dis_vec()
 
     def _A_adj_M(self, stacked_slices_nda_vec):
 
+        # Apply distance weights W so that A^T M W is the adjoint of W M A
+        if self._use_weighted_operator:
+            stacked_slices_nda_vec = \
+                stacked_slices_nda_vec * self._get_slices_dis_vec()
+
         # Allocate memory
         A_adj_M_y = np.zeros(self._N_voxels_recon)
 
@@ -530,6 +844,128 @@ class Solver(object):
 
         return A_adj_M_y
 
+    ##
+    # Get M A as scipy.sparse CSR matrix, i.e. A x = W (M A) x as in _MA
+    # with W given by _get_slices_dis_vec.
+    #
+    # The matrix is assembled once and reused for as long as the slice
+    # positions and the reconstruction grid are unchanged, i.e. until the
+    # next slice-to-volume registration step.
+    # \date       2026-10-17
+    #
+    # \return     M A, scipy.sparse.csr_matrix
+    #
+    def _get_sparse_operator(self):
+        key = self._get_slice_transforms_key()
+        if self._MA_sparse is None or key != self._MA_sparse_key:
+            ph.print_info("Assemble sparse system matrix ... ", newline=False)
+            MA_k = []
+            for stack in self._stacks:
+                for slice_j in stack.get_slices():
+                    MA_k.append(self._get_Mk_Ak_sparse(slice_j))
+            self._MA_sparse = scipy.sparse.vstack(MA_k, format="csr")
+            self._MA_sparse_key = key
+            print("done (%d non-zeros)" % self._MA_sparse.nnz)
+        return self._MA_sparse
+
+    def _get_slice_transforms_key(self):
+        recon_sitk = self._reconstruction.sitk
+        key = [recon_sitk.GetSize(), recon_sitk.GetOrigin(),
+               recon_sitk.GetSpacing(), recon_sitk.GetDirection()]
+        for stack in self._stacks:
+            for slice_k in stack.get_slices():
+                key.append(
+                    slice_k.sitk.GetOrigin() + slice_k.sitk.GetDirection())
+        return tuple(key)
+
+    ##
+    # Sparse representation of M_k A_k for slice k.
+    #
+    # Rows hold the oriented Gaussian PSF weights of the reconstruction
+    # voxels within alpha_cut standard deviations of each slice voxel,
+    # normalized to one, as evaluated by the oriented Gaussian interpolator
+    # behind A_itk.
+    #
+    # \param      slice_k  Slice object
+    # \param      chunk    Number of slice voxels processed at once
+    #
+    def _get_Mk_Ak_sparse(self, slice_k, chunk=4096):
+        recon_sitk = self._reconstruction.sitk
+        recon_size = np.array(recon_sitk.GetSize())
+        recon_spacing = np.array(recon_sitk.GetSpacing())
+        recon_origin = np.array(recon_sitk.GetOrigin())
+        recon_direction = np.array(recon_sitk.GetDirection()).reshape(3, 3)
+
+        slice_sitk = slice_k.sitk
+        slice_direction = np.array(slice_sitk.GetDirection()).reshape(3, 3)
+        N_slice_voxels = np.array(slice_sitk.GetSize()).prod()
+
+        # Oriented PSF covariance expressed along the reconstruction axes
+        in_plane_res = slice_k.get_inplane_resolution()
+        slice_thickness = slice_k.get_slice_thickness()
+        slice_spacing = np.array([in_plane_res, in_plane_res, slice_thickness])
+        U = recon_direction.T.dot(slice_direction)
+        cov = U.dot(np.diag(slice_spacing ** 2 / (8 * np.log(2)))).dot(U.T)
+        cov_inv = np.linalg.inv(cov)
+        cutoff = self._alpha_cut * np.sqrt(np.diag(cov)) / recon_spacing
+
+        # Candidate neighbours relative to the voxel below each position
+        radius = np.ceil(cutoff).astype(int)
+        offsets = np.stack(np.meshgrid(
+            *[np.arange(-r, r + 2) for r in radius], indexing="ij"),
+            axis=-1).reshape(-1, 3)
+
+        # Slice voxel positions as continuous reconstruction indices
+        rows = np.arange(N_slice_voxels)
+        if self._use_masks:
+            mask = sitk.GetArrayFromImage(slice_k.sitk_mask).flatten()
+            rows = rows[mask[rows] != 0]
+        else:
+            mask = np.ones(N_slice_voxels)
+        cindex = (self._get_physical_points(slice_sitk)[rows] -
+                  recon_origin).dot(recon_direction) / recon_spacing
+
+        data, indices, row_indices = [], [], []
+        for c_min in range(0, len(rows), chunk):
+            c = cindex[c_min:c_min + chunk, np.newaxis, :]
+            index = np.floor(c).astype(int) + offsets[np.newaxis]
+            diff = index - c
+            valid = np.all(np.abs(diff) <= cutoff, axis=-1) & \
+                np.all(index >= 0, axis=-1) & \
+                np.all(index < recon_size, axis=-1)
+            diff *= recon_spacing
+            weights = np.exp(-0.5 * np.einsum(
+                "nki,ij,nkj->nk", diff, cov_inv, diff)) * valid
+            weights_sum = weights.sum(axis=1, keepdims=True)
+            weights = np.divide(weights, weights_sum,
+                                out=np.zeros_like(weights),
+                                where=weights_sum > 0)
+            weights *= mask[rows[c_min:c_min + chunk], np.newaxis]
+
+            n, k = np.nonzero(weights)
+            data.append(weights[n, k])
+            # (x, y, z) index to position in the flattened (z, y, x) array
+            indices.append(np.ravel_multi_index(
+                index[n, k][:, ::-1].T, recon_size[::-1]))
+            row_indices.append(rows[c_min + n])
+
+        shape = (N_slice_voxels, self._N_voxels_recon)
+        if len(data) == 0:
+            return scipy.sparse.csr_matrix(shape)
+        return scipy.sparse.csr_matrix(
+            (np.concatenate(data),
+             (np.concatenate(row_indices), np.concatenate(indices))),
+            shape=shape)
+
+    # Physical positions of all voxels, ordered as the flattened array
+    def _get_physical_points(self, image_sitk):
+        dim = image_sitk.GetDimension()
+        spacing = np.array(image_sitk.GetSpacing())
+        origin = np.array(image_sitk.GetOrigin())
+        direction = np.array(image_sitk.GetDirection()).reshape(dim, dim)
+        index = np.indices(image_sitk.GetSize()[::-1]).reshape(dim, -1)[::-1].T
+        return origin + (index * spacing).dot(direction.T)
+
     def _get_itk_image_from_array_vec(self, nda_vec, image_itk_ref):
 
         shape_nda = np.array(
@@ -562,6 +998,11 @@ class TikhonovSolver(Solver):
                  huber_gamma=1.345,
                  predefined_covariance=None,
                  use_masks=True,
+                 use_sparse_operator=False,
+                 use_weighted_operator=False,
+                 warm_start=False,
+                 atol=0,
+                 btol=0,
                  verbose=1,
                  ):
 
@@ -583,17 +1024,35 @@ class TikhonovSolver(Solver):
                         predefined_covariance=predefined_covariance,
                         verbose=verbose,
                         use_masks=use_masks,
+                        use_sparse_operator=use_sparse_operator,
+                        use_weighted_operator=use_weighted_operator,
                         )
 
         # Settings for optimizer
         self._reg_type = reg_type
 
+        # LSMR: start from the current reconstruction instead of zero and
+        # stop on the tolerances atol/btol (0 runs all iter_max iterations)
+        self._warm_start = warm_start
+        self._atol = atol
+        self._btol = btol
+
     def set_regularization_type(self, reg_type):
         self._reg_type = reg_type
 
     def get_regularization_type(self):
         return self._reg_type
 
+    def set_warm_start(self, warm_start):
+        self._warm_start = warm_start
+
+    def get_warm_start(self):
+        return self._warm_start
+
+    def set_tolerances(self, atol, btol):
+        self._atol = atol
+        self._btol = btol
+
     def get_setting_specific_filename(self, prefix="SRR_"):
 
         # Build filename
@@ -664,6 +1123,9 @@ class TikhonovSolver(Solver):
             minimizer=self._minimizer,
             iter_max=self._iter_max,
             bounds=(0, np.inf),
+            warm_start=self._warm_start,
+            atol=self._atol,
+            btol=self._btol,
         )
         return solver
 
@@ -735,7 +1197,10 @@ class TikhonovLinearSolver(LinearSolver):
                  iter_max=10,
                  x_scale=1,
                  verbose=0,
-                 bounds=(0, np.inf)):
+                 bounds=(0, np.inf),
+                 warm_start=False,
+                 atol=0,
+                 btol=0):
 
         super(self.__class__, self).__init__(
             A=A, A_adj=A_adj, b=b, x0=x0, alpha=alpha, iter_max=iter_max,
@@ -749,6 +1214,9 @@ class TikhonovLinearSolver(LinearSolver):
         self.reconstruct_x = reconstruct_x
         self.atlas = atlas
         self.index=index
+        self._warm_start = warm_start
+        self._atol = atol
+        self._btol = btol
 
     def get_B(self):
         return self._B
@@ -786,8 +1254,10 @@ class TikhonovLinearSolver(LinearSolver):
         # Use scipy.sparse.linalg.lsmr
         if self._minimizer == "lsmr" and self._data_loss == "linear":
 
-            # Linear least-squares method
-            self._x = scipy.sparse.linalg.lsmr(A, b,maxiter=self._iter_max,show=self._verbose,atol=0,btol=0)[0]
+            # Linear least-squares method, optionally warm-started from the
+            # current reconstruction, i.e. the previous cycle's solution
+            x0 = self._x0 if self._warm_start else None
+            self._x = scipy.sparse.linalg.lsmr(A, b,maxiter=self._iter_max,show=self._verbose,atol=self._atol,btol=self._btol,x0=x0)[0]
             if self._bounds is not None:
                 # Clip to bounds
                 self._x = np.clip(self._x, self._bounds[0], self._bounds[1])
@@ -845,53 +1315,8 @@ class TikhonovLinearSolver(LinearSolver):
         # Monitor output
         if self._observer is not None:
             self._observer.add_x(self.get_x())
-    def get_correlation(self,move_img, reg_img_1,reg_img_2):
-        I=move_img.numpy()
-        J=reg_img_1.numpy()
-        K=reg_img_2.numpy()
-        u = I.reshape(-1, 1)
-        v = J.reshape(-1, 1)
-        u = u - u.mean(keepdims=True)
-        v = v - v.mean(keepdims=True)
-        NCC_1 = np.mean((np.multiply(u, v)) / (np.std(u) * (np.std(v))))
-
-        w = K.reshape(-1, 1)
-        w = w - w.mean(keepdims=True)
-        NCC_2 = np.mean((np.multiply(u, w)) / (np.std(u) * (np.std(w))))
-
-        if NCC_1>=NCC_2:
-            reg_img=reg_img_1
-        else:
-            reg_img=reg_img_2
-
-        return reg_img
-
     def atlas2ours_transform(self,atlas,reconstruct_x):
-        fix_img = ants.image_read(atlas)
-        rec=sitk.GetArrayFromImage(reconstruct_x.sitk)
-        rec_m=sitk.GetArrayFromImage(reconstruct_x.sitk_mask)
-        rec[rec_m==0]=0
-        rec=sitk.GetImageFromArray(rec)
-        rec.CopyInformation(reconstruct_x.sitk)
-        sitk.WriteImage(rec,"reconstruction_x.nii.gz")
-        move_img = ants.image_read("reconstruction_x.nii.gz")
-        # 配准
-        outs_1 = ants.registration(fix_img, move_img, type_of_transforme='SyN')
-        outs_2 = ants.registration(move_img, fix_img, type_of_transforme='SyN')
-
-        # 获取配准后的数据，并保存
-        reg_img_1 = outs_1['warpedfixout']
-        reg_img_2 = outs_2['warpedmovout']
-        reg_img = self.get_correlation(move_img, reg_img_1,reg_img_2)
-
-
-        ants.image_write(reg_img, "warp_out.nii.gz")
-
-
-
-
-        out=sitk.ReadImage("warp_out.nii.gz")
-        out=sitk.GetArrayFromImage(out)
+        out = atlas.get_warped_atlas(reconstruct_x)
 
         # ref = sitk.ReadImage("reconstruction_x.nii.gz")
         # ref = sitk.GetArrayFromImage(ref)
@@ -899,8 +1324,6 @@ class TikhonovLinearSolver(LinearSolver):
         # out = match_histograms(ref, out)
 
         out=(self.index*out.flatten())/(out.max())
-        # os.remove("warp_out.nii.gz")
-        # os.remove("reconstruction_x.nii.gz")
         return out
     def _get_augmented_linear_system(self, alpha, reconstruct_x, atlas):
 
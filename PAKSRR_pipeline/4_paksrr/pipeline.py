@@ -10,7 +10,9 @@
 # \date       Aug 2017
 #
 import six
+import copy
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import SimpleITK as sitk
 from abc import ABCMeta, abstractmethod
 
@@ -202,6 +204,10 @@ class SliceToVolumeRegistration(RegistrationPipeline):
     # \param      verbose              The verbose
     # \param      print_prefix         Print at each iteration at the
     #                                  beginning, string
+    # \param      n_workers            Number of slices registered
+    #                                  concurrently, integer. Each worker uses
+    #                                  its own copy of registration_method
+    #                                  sharing the read-only reference.
     #
     def __init__(self,
                  stacks,
@@ -212,6 +218,7 @@ class SliceToVolumeRegistration(RegistrationPipeline):
                  print_prefix="",
                  interleave=2,
                  viewer=VIEWER,
+                 n_workers=1,
                  ):
         RegistrationPipeline.__init__(
             self,
@@ -224,15 +231,26 @@ class SliceToVolumeRegistration(RegistrationPipeline):
         )
         self._print_prefix = print_prefix
         self._interleave = interleave
+        self._n_workers = n_workers
 
     def set_print_prefix(self, print_prefix):
         self._print_prefix = print_prefix
 
+    def set_n_workers(self, n_workers):
+        self._n_workers = n_workers
+
+    def get_n_workers(self):
+        return self._n_workers
+
     def _run(self):
         ph.print_title("Slice-to-Volume Registration")
 
         self._registration_method.set_moving(self._reference)
 
+        if self._n_workers > 1:
+            self._run_parallel()
+            return
+
         for i, stack in enumerate(self._stacks):
             slices = stack.get_slices()
             slices_dis = self._stacks_dis[i].get_slices()
@@ -241,23 +259,9 @@ class SliceToVolumeRegistration(RegistrationPipeline):
 
             for j, slice_j in enumerate(slices):
 
-                txt = "%sSlice-to-Volume Registration -- " \
-                      "Stack %d/%d (%s) -- Slice %d/%d" % (
-                          self._print_prefix,
-                          i + 1, len(self._stacks), stack.get_filename(),
-                          j + 1, len(slices))
-                if self._verbose:
-                    ph.print_subtitle(txt)
-                else:
-                    ph.print_info(txt)
-
-                self._registration_method.set_fixed(slice_j)
-                self._registration_method.set_dis(slices_dis[j])
-                self._registration_method.run()
-
                 # Store information on registration transform
-                transform_sitk = \
-                    self._registration_method.get_registration_transform_sitk()
+                transform_sitk = self._register_slice(
+                    self._registration_method, i, stack, j, slices, slices_dis)
                 transforms_sitk[slice_j.get_slice_number()] = transform_sitk
 
             # Update position of slice
@@ -265,6 +269,55 @@ class SliceToVolumeRegistration(RegistrationPipeline):
                 slice_number = slice.get_slice_number()
                 slice.update_motion_correction(transforms_sitk[slice_number])
 
+    ##
+    # Register all slices of all stacks concurrently.
+    #
+    # Slices are independent given the reference, hence every job works on
+    # a shallow copy of the registration method which shares the moving
+    # (reference) volume. Threads are used since Stack objects hold ITK
+    # images which cannot be pickled; SimpleITK and NumPy release the GIL
+    # for the heavy lifting.
+    # \date       2026-10-17
+    #
+    def _run_parallel(self):
+        jobs = []
+        for i, stack in enumerate(self._stacks):
+            slices = stack.get_slices()
+            slices_dis = self._stacks_dis[i].get_slices()
+            for j in range(len(slices)):
+                jobs.append((i, stack, j, slices, slices_dis))
+
+        def register(job):
+            registration_method = copy.copy(self._registration_method)
+            return self._register_slice(registration_method, *job)
+
+        with ThreadPoolExecutor(max_workers=self._n_workers) as executor:
+            transforms_sitk = list(executor.map(register, jobs))
+
+        # Update position of slices once all registrations are done
+        for (i, stack, j, slices, slices_dis), transform_sitk in zip(
+                jobs, transforms_sitk):
+            slices[j].update_motion_correction(transform_sitk)
+
+    def _register_slice(self,
+                        registration_method,
+                        i, stack, j, slices, slices_dis):
+        txt = "%sSlice-to-Volume Registration -- " \
+              "Stack %d/%d (%s) -- Slice %d/%d" % (
+                  self._print_prefix,
+                  i + 1, len(self._stacks), stack.get_filename(),
+                  j + 1, len(slices))
+        if self._verbose:
+            ph.print_subtitle(txt)
+        else:
+            ph.print_info(txt)
+
+        registration_method.set_fixed(slices[j])
+        registration_method.set_dis(slices_dis[j])
+        registration_method.run()
+
+        return registration_method.get_registration_transform_sitk()
+
 
 
 
@@ -351,6 +404,7 @@ class TwoStepSliceToVolumeRegistrationReconstruction(
                  interleave=3,
                  viewer=VIEWER,
                  sigma_sda_mask=1.,
+                 n_workers=1,
                  ):
 
         index=verbose
@@ -385,6 +439,7 @@ class TwoStepSliceToVolumeRegistrationReconstruction(
         self._use_hierarchical_registration = use_hierarchical_registration
         self._interleave = interleave
         self._index = index
+        self._n_workers = n_workers
 
 
     def _run(self):
@@ -398,6 +453,7 @@ class TwoStepSliceToVolumeRegistrationReconstruction(
             registration_method=self._registration_method,
             verbose=False,
             interleave=self._interleave,
+            n_workers=self._n_workers,
         )
 
         reference = self._reference
@@ -2,11 +2,52 @@ from simplereg.niftyreg_to_simpleitk_converter import \
     NiftyRegToSimpleItkConverter as nreg2sitk
 import numpy as np
 import SimpleITK as sitk
+from scipy.optimize import minimize
+
+# Available optimizers:
+#   "gradient_ascent": fixed-step ascent on a central-difference gradient
+#   "lbfgs": L-BFGS-B on the analytic gradient of the weighted correlation
+OPTIMIZERS = ["gradient_ascent", "lbfgs"]
+
+
 class S2V(object):
-    def __init__(self, moving,fixed,dis):
+    def __init__(self, moving,fixed,dis,
+                 optimizer="gradient_ascent",
+                 iter_max=100,
+                 tolerance=1e-6,
+                 shrink_factors=None,
+                 smoothing_sigmas=None,
+                 ):
+        if optimizer not in OPTIMIZERS:
+            raise ValueError("Optimizer must be in " + str(OPTIMIZERS))
+
+        # Single full-resolution level unless a pyramid is given
+        if shrink_factors is None:
+            shrink_factors = [1]
+        if smoothing_sigmas is None:
+            smoothing_sigmas = [0] * len(shrink_factors)
+        if len(shrink_factors) != len(smoothing_sigmas):
+            raise ValueError(
+                "Elements in shrink_factors and smoothing_sigmas must "
+                "correspond to the number of resolution levels")
         self._moving = moving
         self._fixed = fixed
         self._dis = dis
+        self._optimizer = optimizer
+        self._iter_max = iter_max
+        self._tolerance = tolerance
+        self._shrink_factors = shrink_factors
+        self._smoothing_sigmas = smoothing_sigmas
+
+        # Cached resolution pyramids (coarse to fine) and, per level, the
+        # helpers for the analytic gradient
+        self._moving_pyramid = None
+        self._fixed_pyramid = None
+        self._dis_pyramid = None
+        self._moving_gradients = {}
+        self._fixed_points = {}
+
+        self._get_level_iter_max()
 
 
     def get_registration_transform_sitk(self):
@@ -16,10 +57,33 @@ class S2V(object):
 
     def set_moving(self, moving):
         self._moving = moving.sitk
+        # Build the reference pyramid (and gradients) once per cycle so that
+        # copies of this instance (one per parallel worker) share them
+        # instead of each computing their own
+        self._moving_pyramid = self._get_pyramid(self._moving)
+        self._moving_gradients = {}
+        if self._optimizer == "lbfgs":
+            for level in range(len(self._shrink_factors)):
+                self._get_moving_gradient(level)
     def set_fixed(self, fixed):
         self._fixed = fixed.sitk
+        self._fixed_pyramid = None
+        self._fixed_points = {}
     def set_dis(self, dis):
         self._dis = dis.sitk
+        self._dis_pyramid = None
+
+    def set_optimizer(self, optimizer):
+        if optimizer not in OPTIMIZERS:
+            raise ValueError("Optimizer must be in " + str(OPTIMIZERS))
+        self._optimizer = optimizer
+    def get_optimizer(self):
+        return self._optimizer
+
+    def set_iter_max(self, iter_max):
+        self._iter_max = iter_max
+    def get_iter_max(self):
+        return self._iter_max
 
     def correlation(self,I, J, dis):
         if I.shape != J.shape:
@@ -39,6 +103,19 @@ class S2V(object):
         Rz = np.array([[np.cos(z), np.sin(z), 0], [-np.sin(z), np.cos(z), 0], [0, 0, 1]])
         R = np.dot(np.dot(Rx, Ry), Rz)
         return R
+
+    # Partial derivatives of rotate(x, y, z) w.r.t. x, y and z
+    def rotate_derivatives(self, x, y, z):
+        Rx = np.array([[1, 0, 0], [0, np.cos(x), np.sin(x)], [0, -np.sin(x), np.cos(x)]])
+        Ry = np.array([[np.cos(y), 0, -np.sin(y)], [0, 1, 0], [np.sin(y), 0, np.cos(y)]])
+        Rz = np.array([[np.cos(z), np.sin(z), 0], [-np.sin(z), np.cos(z), 0], [0, 0, 1]])
+        dRx = np.array([[0, 0, 0], [0, -np.sin(x), np.cos(x)], [0, -np.cos(x), -np.sin(x)]])
+        dRy = np.array([[-np.sin(y), 0, -np.cos(y)], [0, 0, 0], [np.cos(y), 0, -np.sin(y)]])
+        dRz = np.array([[-np.sin(z), np.cos(z), 0], [-np.cos(z), -np.sin(z), 0], [0, 0, 0]])
+        return (np.dot(np.dot(dRx, Ry), Rz),
+                np.dot(np.dot(Rx, dRy), Rz),
+                np.dot(np.dot(Rx, Ry), dRz))
+
     def ngradient(self,fun, x, h=1e-3):
         g = np.zeros_like(x)
         # print(fun(x)[2])
@@ -52,13 +129,31 @@ class S2V(object):
         # print("g: ", g)
         return g
 
-    def rigid_corr(self,I, Im, x, return_transform=True):
-        SCALING = 100
+    def get_transform_matrix(self, x, scaling=100):
         R = self.rotate(x[0], x[1], x[2])
         Transform = np.zeros((4, 4))
         Transform[:3, :3] = R
-        Transform[:3, 3] = x[3:] * SCALING
+        Transform[:3, 3] = x[3:] * scaling
         Transform[-1, -1] = 1
+        return Transform
+
+    # Partial derivatives of get_transform_matrix(x) w.r.t. the 6 parameters
+    def get_transform_matrix_derivatives(self, x, scaling=100):
+        dTransforms = []
+        for dR in self.rotate_derivatives(x[0], x[1], x[2]):
+            dTransform = np.zeros((4, 4))
+            dTransform[:3, :3] = dR
+            dTransforms.append(dTransform)
+        for k in range(3):
+            dTransform = np.zeros((4, 4))
+            dTransform[k, 3] = scaling
+            dTransforms.append(dTransform)
+        return dTransforms
+
+    def rigid_corr(self,I, Im, x, return_transform=True, dis=None):
+        if dis is None:
+            dis = self._dis
+        Transform = self.get_transform_matrix(x)
         registration_transform_sitk = nreg2sitk.convert_regaladin_to_sitk_transform(
             Transform, dim=I.GetDimension())
         warped_moving_sitk = sitk.Resample(
@@ -72,26 +167,203 @@ class S2V(object):
         # sitk.WriteImage(warped_moving_sitk, "warp.nii.gz")
         self.warped_moving_sitk=warped_moving_sitk
         Im_t = sitk.GetArrayFromImage(warped_moving_sitk).squeeze()
-        C = self.correlation(sitk.GetArrayFromImage(I).squeeze(), Im_t,sitk.GetArrayFromImage(self._dis).squeeze())
+        C = self.correlation(sitk.GetArrayFromImage(I).squeeze(), Im_t,sitk.GetArrayFromImage(dis).squeeze())
         if return_transform:
             return C, Im_t, Transform
         else:
             return C
 
+    ##
+    # Distance-weighted correlation and its analytic gradient w.r.t. x,
+    # evaluated at the given resolution level (default: full resolution).
+    #
+    # The warped slice is J(x)_i = Im(T_x(p_i)) with T_x(p) = A p + c, so
+    # dJ_i/dx = grad Im(T_x(p_i)) . dT_x(p_i)/dx. The moving image gradient is
+    # resampled with the same transform, i.e. one scalar plus one vector
+    # resampling per evaluation.
+    #
+    # \return     correlation C and gradient dC/dx, numpy array of size 6
+    #
+    def rigid_corr_gradient(self, x, level=-1):
+        I, Im, dis = self._get_level(level)
+        dim = I.GetDimension()
+        registration_transform_sitk = nreg2sitk.convert_regaladin_to_sitk_transform(
+            self.get_transform_matrix(x), dim=dim)
+        warped_moving_sitk = sitk.Resample(
+            Im,
+            I,
+            registration_transform_sitk,
+            sitk.sitkLinear,
+            0.,
+            I.GetPixelIDValue()
+        )
+        self.warped_moving_sitk = warped_moving_sitk
+        warped_gradient_sitk = sitk.Resample(
+            self._get_moving_gradient(level),
+            I,
+            registration_transform_sitk,
+            sitk.sitkLinear,
+            0.,
+        )
 
-    def run(self):
-        x = np.array([0., 0., 0., 0., 0., 0.])
+        u = sitk.GetArrayFromImage(I).flatten().astype(np.float64)
+        v = sitk.GetArrayFromImage(warped_moving_sitk).flatten().astype(np.float64)
+        d = sitk.GetArrayFromImage(dis).flatten().astype(np.float64)
+        dJ = sitk.GetArrayFromImage(warped_gradient_sitk).reshape(-1, dim)
+        u = u - u.mean()
+        v = v - v.mean()
+        norm_u = np.sqrt(u.dot(u))
+        norm_v = np.sqrt(v.dot(v))
+        if norm_u == 0 or norm_v == 0:
+            return 0., np.zeros_like(x)
+
+        f = d.dot(u * v)
+        C = f / (norm_u * norm_v)
+
+        # dC/dJ; centering of J is accounted for by subtracting the mean
+        du = d * u
+        dC_dJ = ((du - du.mean()) / norm_v - f * v / norm_v ** 3) / norm_u
+
+        # Contract dC/dJ * grad Im with the fixed voxel positions once, so
+        # that each parameter only needs the derivative of (A, c)
+        w = dJ * dC_dJ[:, np.newaxis]
+        w_points = w.T.dot(self._get_fixed_points(level))
+        w_sum = w.sum(axis=0)
+
+        grad = np.zeros_like(x)
+        for k, dTransform in enumerate(self.get_transform_matrix_derivatives(x)):
+            dA, dc = self._get_affine_parameters(dTransform, dim)
+            grad[k] = np.sum(dA * w_points) + dc.dot(w_sum)
+        return C, grad
+
+    # RegAladin to SimpleITK conversion is a fixed change of basis, hence
+    # linear in the matrix. This maps derivatives of Transform as well.
+    def _get_affine_parameters(self, Transform, dim):
+        transform_sitk = nreg2sitk.convert_regaladin_to_sitk_transform(
+            Transform, dim=dim)
+        A = np.array(transform_sitk.GetMatrix()).reshape(dim, dim)
+        c = np.array(transform_sitk.GetTranslation())
+        return A, c
+
+    ##
+    # Smoothed and shrunk copies of image, one per resolution level, coarse
+    # to fine. Only axes with more than one voxel are smoothed and shrunk,
+    # i.e. slices stay single-slice images. Sigmas are in mm.
+    #
+    def _get_pyramid(self, image):
+        dim = image.GetDimension()
+        axes = [size > 1 for size in image.GetSize()]
+        pyramid = []
+        for shrink_factor, sigma in zip(
+                self._shrink_factors, self._smoothing_sigmas):
+            level_image = image
+            if sigma > 0:
+                level_image = sitk.DiscreteGaussian(
+                    level_image,
+                    variance=[sigma ** 2 if axis else 0 for axis in axes],
+                    maximumKernelWidth=32,
+                    maximumError=0.01,
+                    useImageSpacing=True,
+                )
+            if shrink_factor > 1:
+                level_image = sitk.BinShrink(
+                    level_image,
+                    [int(shrink_factor) if axis else 1 for axis in axes])
+            pyramid.append(level_image)
+        return pyramid
+
+    def _get_level(self, level):
+        if self._fixed_pyramid is None:
+            self._fixed_pyramid = self._get_pyramid(self._fixed)
+        if self._dis_pyramid is None:
+            self._dis_pyramid = self._get_pyramid(self._dis)
+        if self._moving_pyramid is None:
+            self._moving_pyramid = self._get_pyramid(self._moving)
+        return (self._fixed_pyramid[level],
+                self._moving_pyramid[level],
+                self._dis_pyramid[level])
+
+    def _get_moving_gradient(self, level):
+        level = level % len(self._shrink_factors)
+        if level not in self._moving_gradients:
+            if self._moving_pyramid is None:
+                self._moving_pyramid = self._get_pyramid(self._moving)
+            self._moving_gradients[level] = sitk.Gradient(
+                sitk.Cast(self._moving_pyramid[level], sitk.sitkFloat64),
+                useImageSpacing=True,
+                useImageDirection=True,
+            )
+        return self._moving_gradients[level]
+
+    # Physical positions of all fixed voxels, ordered as the flattened array
+    def _get_fixed_points(self, level):
+        level = level % len(self._shrink_factors)
+        if level not in self._fixed_points:
+            fixed = self._get_level(level)[0]
+            dim = fixed.GetDimension()
+            size = fixed.GetSize()
+            spacing = np.array(fixed.GetSpacing())
+            origin = np.array(fixed.GetOrigin())
+            direction = np.array(fixed.GetDirection()).reshape(dim, dim)
+            index = np.indices(size[::-1]).reshape(dim, -1)[::-1].T
+            self._fixed_points[level] = origin + (index * spacing).dot(direction.T)
+        return self._fixed_points[level]
+
+    # Iterations per level, coarse to fine. An int budget is split in
+    # proportion to the shrink factors so that most iterations run at low
+    # resolution, e.g. 100 with [3, 2, 1] gives [50, 33, 17]; the
+    # full-resolution level gets the remainder (at least 1). A list gives
+    # the iterations of each level explicitly.
+    def _get_level_iter_max(self):
+        n_levels = len(self._shrink_factors)
+        if isinstance(self._iter_max, (list, tuple)):
+            if len(self._iter_max) != n_levels:
+                raise ValueError(
+                    "Elements in iter_max must correspond to the number "
+                    "of resolution levels")
+            return [int(i) for i in self._iter_max]
+        weights = np.array(self._shrink_factors, dtype=float)
+        level_iter_max = np.floor(
+            int(self._iter_max) * weights / weights.sum()).astype(int)
+        level_iter_max[-1] = max(
+            int(self._iter_max) - level_iter_max[:-1].sum(), 1)
+        return level_iter_max.tolist()
+
+    def _run_gradient_ascent(self, x, level, iter_max):
+        x = x.copy()
         mu = 0.0003
-        fun = lambda x: self.rigid_corr(self._fixed, self._moving, x)
-        for k in np.arange(100):
+        fixed, moving, dis = self._get_level(level)
+        fun = lambda x: self.rigid_corr(fixed, moving, x, dis=dis)
+        for k in np.arange(iter_max):
             # print("X: ", x)
             g = self.ngradient(fun, x)
             x += g * mu
-        R = self.rotate(x[0], x[1], x[2])
-        Transform = np.zeros((4, 4))
-        Transform[:3, :3] = R
-        Transform[:3, 3] = x[3:] * 100
-        Transform[-1, -1] = 1
+        return x
+
+    def _run_lbfgs(self, x, level, iter_max):
+        def fun(x):
+            C, grad = self.rigid_corr_gradient(x, level)
+            return -C, -grad
+        x = minimize(
+            fun,
+            x,
+            jac=True,
+            method="L-BFGS-B",
+            options={
+                "maxiter": iter_max,
+                "ftol": self._tolerance,
+                "gtol": self._tolerance,
+            }).x
+        return x
+
+    # Coarse-to-fine: each level starts from the previous level's estimate
+    def run(self):
+        x = np.array([0., 0., 0., 0., 0., 0.])
+        for level, iter_max in enumerate(self._get_level_iter_max()):
+            if self._optimizer == "lbfgs":
+                x = self._run_lbfgs(x, level, iter_max)
+            else:
+                x = self._run_gradient_ascent(x, level, iter_max)
+        Transform = self.get_transform_matrix(x)
         self.transform_sitk = nreg2sitk.convert_regaladin_to_sitk_transform(
             Transform, dim=self._fixed.GetDimension())
-